@@ -7,19 +7,41 @@
 # Version: 2015-11-04
 
 import argparse
+import base64
+import BaseHTTPServer
 import collections
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import httplib
 import json
+import mimetypes
+import multiprocessing.pool
 import os
 import os.path
 import re
 import shutil
+import socket
+import SocketServer
+import StringIO
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import traceback
 import urllib2
+import urlparse
+import zlib
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
 
 # TODO: Single CSS file?
 # TODO: Automatic GIT ignore
-# TODO: CSS minification
 
 _DESCRIPTION="""Compile JavaScript and CSS files for a web application.
 
@@ -55,6 +77,90 @@ def _get_cache_dir(path):
   return os.path.join(dirname, '.' + basename + '.cache')
 
 
+def _get_manifest_path(path):
+  dirname, basename = os.path.split(path)
+  return os.path.join(dirname, '.' + basename + '.manifest')
+
+
+def _hash_contents(contents):
+  return hashlib.sha1(_encode(contents)).hexdigest()
+
+
+def _hash_file(path):
+  sha1 = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(65536), ''):
+      sha1.update(chunk)
+  return sha1.hexdigest()
+
+
+def _run_in_threads(functions):
+  """Call every function of a list in its own thread, and wait for all of
+     them.  Return the list of the sys.exc_info() of the functions which
+     raised an exception, in the order of the list.
+  """
+  errors = [None] * len(functions)
+  def call(i):
+    try:
+      functions[i]()
+    except Exception:
+      errors[i] = sys.exc_info()
+  threads = [threading.Thread(target=call, args=(i,))
+             for i in range(len(functions))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return [error for error in errors if error is not None]
+
+
+def _parse_size(value):
+  """Parse a size like '300', '300k' or '2M' into a number of bytes."""
+  match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)[bB]?\s*$', value)
+  if not match:
+    raise FatalError('Invalid size: ' + value)
+  factor = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+  return int(float(match.group(1)) * factor[match.group(2).lower()])
+
+
+def _write_file_atomic(path, contents):
+  dirname = os.path.dirname(path)
+  if dirname and not os.path.exists(dirname):
+    os.makedirs(dirname)
+  tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(),
+                               threading.current_thread().ident)
+  with open(tmp_path, 'wb') as f:
+    f.write(contents)
+  os.rename(tmp_path, path)
+
+
+def _sync_file(source, dest):
+  """Make dest a copy of source, as a hard link if possible.  Nothing is
+     done if dest is identical to source (same size, and same modification
+     time or contents), so that its modification time is kept.  Return True
+     if dest has been written.
+  """
+  if os.path.isfile(dest):
+    if os.path.samefile(source, dest):
+      return False
+    source_stat = os.stat(source)
+    dest_stat = os.stat(dest)
+    if (source_stat.st_size == dest_stat.st_size and
+        (abs(source_stat.st_mtime - dest_stat.st_mtime) < 1e-3 or
+         _hash_file(source) == _hash_file(dest))):
+      return False
+  tmp_path = '%s.%d.%d.tmp' % (dest, os.getpid(),
+                               threading.current_thread().ident)
+  try:
+    os.link(source, tmp_path)
+  except OSError:
+    # Different file systems, or no hard links: copy with the modification
+    # time of the source.
+    shutil.copy2(source, tmp_path)
+  os.rename(tmp_path, dest)
+  return True
+
+
 # *************************************************************************
 # Encoding functions
 
@@ -66,6 +172,22 @@ def _encode(s):
   return str(s)
 
 
+def _decode_source(s):
+  """Decode the contents of a source file, as utf-8 when possible, and
+     as latin-1 otherwise, which keeps the value of every byte.
+  """
+  try:
+    return s.decode('utf-8')
+  except UnicodeDecodeError:
+    return s.decode('latin-1')
+
+
+# The "use strict" directive at the start of a JavaScript program, after
+# any comments.
+_JS_USE_STRICT = re.compile(
+  r'(?:\s+|//[^\n]*|/\*.*?\*/)*([\'"])use strict\1', re.DOTALL)
+
+
 def _escape_less(s):
   return re.sub(r'''['"\n\\]''', lambda m: '\\{:X} '.format(ord(m.group())), s)
 
@@ -98,6 +220,23 @@ cherry.include_less = function(path) {
       cherry.rewrite_path(path) + '">');
 };
 
+cherry.eval_script = function(text) {
+  // Unlike an indirect eval, a script element keeps the declarations of
+  // strict code global.  Inline scripts run as soon as they are inserted.
+  var element = global.document.createElement('script');
+  element.text = text;
+  (global.document.head || global.document.documentElement)
+    .appendChild(element);
+};
+
+cherry.live_reload = function(path) {
+  if (!global.EventSource) return;
+  var source = new global.EventSource(cherry.rewrite_path(path));
+  source.onmessage = function(event) {
+    if (event.data == 'reload') global.location.reload();
+  };
+};
+
 cherry.is_absolute = function(url) {
   return url.startsWith('/') || url.indexOf('://') > 0;
 }
@@ -121,6 +260,73 @@ _JS_RUNTIME_END = """
 })(this);
 """
 
+# *************************************************************************
+# Profiling
+
+
+class Profiler(object):
+  """Record the spans of a build as Chrome trace events, which can be
+     viewed with chrome://tracing or Perfetto.  Spans are recorded with the
+     process and thread which ran them.
+  """
+
+  def __init__(self):
+    self._events = []
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def span(self, name, category, args):
+    start = time.time()
+    try:
+      yield args
+    finally:
+      event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': int(start * 1e6),
+        'dur': int((time.time() - start) * 1e6),
+        'pid': os.getpid(),
+        'tid': threading.current_thread().ident,
+        'args': args
+      }
+      with self._lock:
+        self._events.append(event)
+
+  def get_events(self):
+    with self._lock:
+      return list(self._events)
+
+  def add_events(self, events):
+    """Add the events recorded by another process."""
+    with self._lock:
+      self._events.extend(events)
+
+  def write(self, path):
+    events = self.get_events()
+    for pid in sorted(set(event['pid'] for event in events)):
+      events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                     'args': {'name': 'cherry (%d)' % pid}})
+    with open(path, 'w') as f:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# The profiler of the current process, or None if profiling is disabled.
+_profiler = None
+
+
+@contextlib.contextmanager
+def _span(name, category, **args):
+  """Record a span if profiling is enabled.  The arguments of the span are
+     yielded, so that results can be added to them.
+  """
+  if _profiler is None:
+    yield args
+  else:
+    with _profiler.span(name, category, args):
+      yield args
+
+
 # *************************************************************************
 # Run external commands
 
@@ -139,31 +345,98 @@ class RunError(Exception):
                         for name, value in attritems]))
 
 
-def run(command, arguments=[], inputs=[]):
-  try:
-    process = subprocess.Popen(
-      [command] + arguments,
-      bufsize=1,  # Line buffered
-      stdin=subprocess.PIPE,
-      stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE)
-    for i in inputs:
-      process.stdin.write(i)
-    process.stdin.close()
-    stdout = process.stdout.readlines()
-    stderr = process.stderr.readlines()
-    retcode = process.wait()
-    if retcode != 0:
+class RunStats(object):
+  """Resources used by a command run by run_with_stats."""
+
+  def __init__(self, wall_time, cpu_time, max_rss):
+    self.wall_time = wall_time
+    self.cpu_time = cpu_time
+    self.max_rss = max_rss  # In kilobytes (as reported by Linux).
+
+  def __str__(self):
+    return '%.2fs wall, %.2fs CPU, %d KB max RSS' % (
+      self.wall_time, self.cpu_time, self.max_rss)
+
+
+def run_with_stats(command, arguments=[], inputs=[]):
+  """Run a command, and return the lines of its standard output and its
+     RunStats.  inputs is a list of strings and file objects, which are
+     streamed to the standard input of the command.  Standard input, output
+     and error are handled by separate threads, so that the command cannot
+     block on a full pipe.
+  """
+  with _span('run ' + os.path.basename(command), 'run',
+             argv=[command] + arguments) as span_args:
+    start = time.time()
+    try:
+      process = subprocess.Popen(
+        [command] + arguments,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        # Do not leak the pipes of commands run concurrently by other threads.
+        close_fds=True)
+    except OSError as e:
+      raise RunError("The command '" + command + "' cannot be run.", e,
+                     command=command,
+                     arguments=arguments)
+    input_bytes = [0]
+    def feed():
+      try:
+        for i in inputs:
+          if hasattr(i, 'read'):
+            try:
+              for chunk in iter(lambda: i.read(65536), ''):
+                input_bytes[0] += len(chunk)
+                process.stdin.write(chunk)
+            finally:
+              i.close()
+          else:
+            input_bytes[0] += len(i)
+            process.stdin.write(i)
+      except IOError:
+        pass  # The command exited without reading all its input.
+      finally:
+        try:
+          process.stdin.close()
+        except IOError:
+          pass
+    stdout = []
+    stderr = []
+    def drain(pipe, chunks):
+      for chunk in iter(lambda: os.read(pipe.fileno(), 65536), ''):
+        chunks.append(chunk)
+    threads = [threading.Thread(target=feed),
+               threading.Thread(target=drain, args=(process.stdout, stdout)),
+               threading.Thread(target=drain, args=(process.stderr, stderr))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    _, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+      process.returncode = -os.WTERMSIG(status)
+    else:
+      process.returncode = os.WEXITSTATUS(status)
+    stats = RunStats(time.time() - start,
+                     rusage.ru_utime + rusage.ru_stime,
+                     rusage.ru_maxrss)
+    span_args['input_bytes'] = input_bytes[0]
+    span_args['output_bytes'] = sum(len(chunk) for chunk in stdout)
+    span_args['cpu_time'] = stats.cpu_time
+    span_args['max_rss'] = stats.max_rss
+    if process.returncode != 0:
       raise RunError("The command '" + command + "' failed",
                      command=command,
                      arguments=arguments,
-                     stderr="\n".join(stderr),
-                     retcode=retcode)
-    return stdout
-  except OSError as e:
-    raise RunError("The command '" + command + "' cannot be run.", e,
-                   command=command,
-                   arguments=arguments)
+                     stderr=''.join(stderr),
+                     retcode=process.returncode)
+    return ''.join(stdout).splitlines(True), stats
+
+
+def run(command, arguments=[], inputs=[]):
+  stdout, _ = run_with_stats(command, arguments, inputs)
+  return stdout
 
 
 # *************************************************************************
@@ -177,7 +450,346 @@ def read_url(url, use_wget=False):
       raise urllib2.URLError(e)
   else:
     return urllib2.urlopen(url).read()
-  
+
+
+class Response(object):
+  """The result of an HTTP request made by a Downloader."""
+
+  def __init__(self, url, status, headers, body):
+    self.url = url
+    self.status = status
+    self.headers = headers
+    self.body = body
+
+
+class Downloader(object):
+  """Download remote files.
+
+  Requests are made with httplib, and every thread keeps one keep-alive
+  connection per host.  map() runs a function on a list of items in a
+  bounded pool of threads, so that several files can be downloaded at the
+  same time.
+  """
+
+  _MAX_REDIRECTS = 5
+  _REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+  def __init__(self, parameters):
+    self._use_wget = parameters.get_bool(Param.USE_WGET)
+    self._jobs = parameters.get_int(Param.DOWNLOAD_JOBS, 8)
+    self._timeout = parameters.get_float(Param.DOWNLOAD_TIMEOUT, 30)
+    self._retries = parameters.get_int(Param.DOWNLOAD_RETRIES, 2)
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._all_connections = []
+    self._pool = None
+
+  def map(self, function, items):
+    if len(items) <= 1 or self._jobs <= 1:
+      return map(function, items)
+    if self._pool is None:
+      self._pool = multiprocessing.pool.ThreadPool(self._jobs)
+    return self._pool.map(function, items)
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+    with self._lock:
+      for connection in self._all_connections:
+        connection.close()
+      self._all_connections = []
+
+  def read(self, url):
+    return self.fetch(url).body
+
+  def fetch(self, url, headers={}):
+    """Download url, and return a Response.  Raise urllib2.URLError if
+       the file cannot be downloaded.
+    """
+    with _span('download ' + url, 'download', url=url) as span_args:
+      response = self._fetch_with_retries(url, headers)
+      span_args['status'] = response.status
+      span_args['bytes'] = len(response.body)
+      return response
+
+  def _fetch_with_retries(self, url, headers):
+    if self._use_wget:
+      return Response(url, 200, {}, read_url(url, True))
+    error = None
+    for _ in range(self._retries + 1):
+      try:
+        return self._fetch(url, headers, self._MAX_REDIRECTS)
+      except (socket.error, httplib.HTTPException) as e:
+        error = e
+    raise urllib2.URLError(error)
+
+  def _get_connections(self):
+    if not hasattr(self._local, 'connections'):
+      self._local.connections = {}
+    return self._local.connections
+
+  def _fetch(self, url, headers, redirects):
+    parts = urlparse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+      return Response(url, 200, {},
+                      urllib2.urlopen(url, timeout=self._timeout).read())
+    path = parts.path or '/'
+    if parts.query:
+      path += '?' + parts.query
+    connections = self._get_connections()
+    key = (parts.scheme, parts.netloc)
+    connection = connections.get(key)
+    if connection is None:
+      if parts.scheme == 'https':
+        connection = httplib.HTTPSConnection(parts.netloc,
+                                             timeout=self._timeout)
+      else:
+        connection = httplib.HTTPConnection(parts.netloc,
+                                            timeout=self._timeout)
+      connections[key] = connection
+      with self._lock:
+        self._all_connections.append(connection)
+    try:
+      connection.request('GET', path, headers=headers)
+      response = connection.getresponse()
+      body = response.read()
+    except:
+      connection.close()
+      del connections[key]
+      raise
+    location = response.getheader('location')
+    if response.status in self._REDIRECT_STATUSES and location:
+      if redirects == 0:
+        raise urllib2.URLError('Too many redirections: ' + url)
+      return self._fetch(urlparse.urljoin(url, location), headers,
+                         redirects - 1)
+    if response.status >= 400:
+      raise urllib2.HTTPError(url, response.status, response.reason,
+                              response.msg, None)
+    return Response(url, response.status, dict(response.getheaders()), body)
+
+
+
+# *************************************************************************
+# Source maps
+
+_BASE64_DIGITS = (
+  'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/')
+
+
+def _decode_mappings(mappings):
+  """Decode the mappings of a source map, as a list of lines, each line being
+     a list of segments with absolute values.
+  """
+  lines = []
+  fields = [0, 0, 0, 0, 0]
+  for line in mappings.split(';'):
+    segments = []
+    fields[0] = 0
+    for segment in line.split(','):
+      if not segment:
+        continue
+      values = []
+      value = shift = 0
+      for c in segment:
+        digit = _BASE64_DIGITS.index(c)
+        value += (digit & 31) << shift
+        if digit & 32:
+          shift += 5
+        else:
+          values.append(-(value >> 1) if value & 1 else value >> 1)
+          value = shift = 0
+      for i, v in enumerate(values):
+        fields[i] += v
+      segments.append(fields[:len(values)])
+    lines.append(segments)
+  return lines
+
+
+def _encode_mappings(lines):
+  previous = [0, 0, 0, 0, 0]
+  encoded_lines = []
+  for segments in lines:
+    previous[0] = 0
+    encoded_segments = []
+    for segment in segments:
+      encoded = ''
+      for i, v in enumerate(segment):
+        delta = v - previous[i]
+        previous[i] = v
+        vlq = ((-delta) << 1) | 1 if delta < 0 else delta << 1
+        while True:
+          digit = vlq & 31
+          vlq >>= 5
+          encoded += _BASE64_DIGITS[digit | (32 if vlq else 0)]
+          if not vlq:
+            break
+      encoded_segments.append(encoded)
+    encoded_lines.append(','.join(encoded_segments))
+  return ';'.join(encoded_lines)
+
+
+def _read_input_source_map(path, contents, outdir):
+  """Return the source map of a source file (referenced by a sourceMappingURL
+     comment, or stored next to the file), with sources relative to outdir.
+     Return None if the file has no source map.
+  """
+  match = re.search(r'[#@] sourceMappingURL=(\S+)\s*$', contents[-1000:])
+  source_map = None
+  map_dir = os.path.dirname(path)
+  try:
+    if match and match.group(1).startswith('data:'):
+      source_map = json.loads(base64.b64decode(match.group(1).split(',', 1)[1]))
+    else:
+      if match and not _is_url(match.group(1)):
+        map_path = os.path.join(map_dir, match.group(1))
+      else:
+        map_path = path + '.map'
+      if not os.path.isfile(map_path):
+        return None
+      map_dir = os.path.dirname(map_path)
+      with open(map_path, 'r') as f:
+        source_map = json.load(f)
+  except (ValueError, TypeError, IOError):
+    return None
+  root = source_map.get('sourceRoot') or ''
+  source_map['sources'] = [
+    source if _is_url(root + source) else
+    os.path.relpath(os.path.join(map_dir, root, source), outdir)
+    for source in source_map['sources']]
+  return source_map
+
+
+def _compose_source_maps(source_map, source_names, input_maps):
+  """Compose a source map with the source maps of its sources.
+
+  source_names gives the new name of every source of source_map, and
+  input_maps maps the index of some sources to their own source map.  The
+  positions in these sources are mapped through their source map, so that
+  the result points to the original files.
+  """
+  sources = []
+  contents = []
+  source_ids = {}
+  names = []
+  name_ids = {}
+  def get_source_id(source, content):
+    if source not in source_ids:
+      source_ids[source] = len(sources)
+      sources.append(source)
+      contents.append(content)
+    return source_ids[source]
+  def get_name_id(name):
+    if name not in name_ids:
+      name_ids[name] = len(names)
+      names.append(name)
+    return name_ids[name]
+  def get_content(source_map, i):
+    source_contents = source_map.get('sourcesContent') or []
+    return source_contents[i] if i < len(source_contents) else None
+  input_lines = dict((i, _decode_mappings(input_map['mappings']))
+                     for i, input_map in input_maps.items())
+  lines = []
+  for segments in _decode_mappings(source_map['mappings']):
+    new_segments = []
+    for segment in segments:
+      if len(segment) < 4:
+        new_segments.append(segment[:1])
+        continue
+      source, line, column = segment[1:4]
+      name = source_map['names'][segment[4]] if len(segment) == 5 else None
+      if source in input_maps:
+        input_map = input_maps[source]
+        found = None
+        if line < len(input_lines[source]):
+          for input_segment in input_lines[source][line]:
+            if input_segment[0] > column:
+              break
+            found = input_segment
+        if found is None or len(found) < 4:
+          new_segments.append(segment[:1])
+          continue
+        source_id = get_source_id(input_map['sources'][found[1]],
+                                  get_content(input_map, found[1]))
+        line, column = found[2], found[3]
+        if len(found) == 5:
+          name = input_map['names'][found[4]]
+      else:
+        source_id = get_source_id(source_names[source],
+                                  get_content(source_map, source))
+      new_segment = [segment[0], source_id, line, column]
+      if name is not None:
+        new_segment.append(get_name_id(name))
+      new_segments.append(new_segment)
+    lines.append(new_segments)
+  result = {
+    'version': 3,
+    'sources': sources,
+    'names': names,
+    'mappings': _encode_mappings(lines)
+  }
+  if source_map.get('file'):
+    result['file'] = source_map['file']
+  if any(content is not None for content in contents):
+    result['sourcesContent'] = contents
+  return result
+
+
+# *************************************************************************
+# CSS
+
+_CSS_STRING = r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\''
+_CSS_TOKENS = re.compile(
+  r'(%s)|(/\*.*?\*/)|url\(\s*(%s|[^)\s]*)\s*\)|(\s+)' % (
+    _CSS_STRING, _CSS_STRING),
+  re.DOTALL | re.IGNORECASE)
+_CSS_SPACES = re.compile(r'(%s)|[\s;]*(})\s*|\s*([{;,>])\s*|(:)\s+' %
+                         _CSS_STRING)
+
+
+def _rewrite_css_url(url, source, outdir):
+  if re.match(r'^([a-zA-Z][a-zA-Z0-9+.-]*:|#)', url) or not url:
+    return url
+  elif _is_url(source):
+    return urlparse.urljoin(source, url)
+  elif url.startswith('/'):
+    return url
+  else:
+    match = re.match(r'^([^?#]*)(.*)$', url)
+    path = os.path.relpath(
+      os.path.join(os.path.dirname(source), match.group(1)), outdir or '.')
+    return path.replace(os.sep, '/') + match.group(2)
+
+
+def _process_css(contents, source, outdir, minify):
+  """Rewrite the relative url() of a stylesheet, read from source (a path or
+     an URL), so that they are relative to outdir.  If minify is True, also
+     remove its comments and its useless whitespace.
+  """
+  def replace_token(match):
+    string, comment, url, spaces = match.groups()
+    if string is not None:
+      return string
+    elif comment is not None:
+      return '' if minify else comment
+    elif url is not None:
+      quote = url[0] if url[:1] in ('"', "'") else ''
+      if quote:
+        url = url[1:-1]
+      return 'url(%s%s%s)' % (quote, _rewrite_css_url(url, source, outdir),
+                              quote)
+    else:
+      return ' ' if minify else spaces
+  contents = _CSS_TOKENS.sub(replace_token, contents)
+  if minify:
+    # Spaces are kept before colons, which start pseudo-classes in
+    # selectors.
+    contents = _CSS_SPACES.sub(
+      lambda match: ''.join(group for group in match.groups() if group),
+      contents).strip()
+  return contents
 
 
 # *************************************************************************
@@ -198,15 +810,38 @@ class File(object):
   def read(self):
     raise NotImplementedError
 
+  def get_id(self):
+    """Return a normalized identity for the file (e.g. an absolute path or
+       an URL), or None if it has no identity.
+    """
+    return None
+
+  def open(self):
+    """Return a file object to read the contents."""
+    return StringIO.StringIO(self.read())
+
+  def get_hash(self):
+    """Return the SHA-1 of the contents."""
+    return _hash_contents(self.read())
+
 
 class FSFile(File):
   """A source file stored on the file system."""
 
-  def __init__(self, path, type_=None):
+  def __init__(self, path, type_=None, generated=False):
     File.__init__(self)
     self._path = path
     self._contents = None
+    self._hash = None
     self._type = type_ or os.path.splitext(self._path)[1][1:]
+    self._generated = generated
+
+  def is_generated(self):
+    """Return True if the file is generated by the build."""
+    return self._generated
+
+  def get_id(self):
+    return os.path.realpath(self._path)
 
   def get_type(self):
     return self._type
@@ -216,26 +851,324 @@ class FSFile(File):
 
   def read(self):
     if self._contents is None:
-      with open(self._path, 'r') as f:
-        self._contents = f.read()
+      with _span('read ' + self._path, 'read', path=self._path) as span_args:
+        with open(self._path, 'r') as f:
+          self._contents = f.read()
+        span_args['bytes'] = len(self._contents)
     return self._contents
 
+  def open(self):
+    if self._contents is None:
+      return open(self._path, 'r')
+    return File.open(self)
+
+  def get_hash(self):
+    # The file is hashed by chunks, so that it is not kept in memory if it
+    # is only streamed to a command.
+    if self._hash is None:
+      if self._contents is None:
+        self._hash = _hash_file(self._path)
+      else:
+        self._hash = _hash_contents(self._contents)
+    return self._hash
+
+
+class LocalUrlCache(object):
+  """The cache of remote files of a manifest, stored in its cache
+     directory.
+  """
+
+  def __init__(self, cache_dir, type_):
+    self._cache_dir = cache_dir
+    self._type = type_
+
+  def get_path(self, url):
+    if not os.path.exists(self._cache_dir):
+      os.makedirs(self._cache_dir)
+    cache_path = os.path.join(
+      self._cache_dir, url.replace(':', '_').replace('/', '_').replace('?', '_'))
+    if not cache_path.endswith('.' + self._type):
+      cache_path += '.' + self._type
+    return cache_path
+
+  def exists(self, url):
+    return os.path.isfile(self.get_path(url))
+
+  def read(self, url):
+    with open(self.get_path(url), 'r') as f:
+      return f.read()
+
+  def get_meta(self, url):
+    try:
+      with open(self.get_path(url) + '.meta', 'r') as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def set_meta(self, url, meta):
+    _write_file_atomic(self.get_path(url) + '.meta', json.dumps(meta))
+
+  def put(self, url, contents, meta):
+    _write_file_atomic(self.get_path(url), contents)
+    self.set_meta(url, meta)
+
+
+class SharedCache(object):
+  """A cache of remote files shared by all the projects of a machine.
+
+  Entries are keyed by the hash of their URL.  Their contents are stored in
+  blobs named by the hash of the contents, so that identical files are
+  stored once.  The index records the last access time of every entry, and
+  the least recently used entries are evicted when the total size of the
+  blobs exceeds max_size.  All accesses to the index are made under an
+  exclusive flock, so that several processes may use the cache at the same
+  time.
+  """
+
+  def __init__(self, root, max_size):
+    self._root = root
+    self._max_size = max_size
+    self._index_path = os.path.join(root, 'index.json')
+    self._lock_path = os.path.join(root, 'index.lock')
+
+  def _get_blob_path(self, blob):
+    return os.path.join(self._root, 'blobs', blob[:2], blob)
+
+  @contextlib.contextmanager
+  def _open_index(self, write):
+    if not os.path.exists(self._root):
+      try:
+        os.makedirs(self._root)
+      except OSError:
+        if not os.path.isdir(self._root):
+          raise
+    with open(self._lock_path, 'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        try:
+          with open(self._index_path, 'r') as f:
+            index = json.load(f)
+        except (IOError, ValueError):
+          index = {}
+        yield index
+        if write:
+          self._evict(index)
+          _write_file_atomic(self._index_path, json.dumps(index))
+      finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+  def exists(self, url):
+    with self._open_index(False) as index:
+      return _hash_contents(url) in index
+
+  def read(self, url):
+    with self._open_index(True) as index:
+      entry = index.get(_hash_contents(url))
+      if entry is None:
+        return None
+      entry['atime'] = time.time()
+      with open(self._get_blob_path(entry['blob']), 'r') as f:
+        return f.read()
+
+  def get_meta(self, url):
+    with self._open_index(False) as index:
+      entry = index.get(_hash_contents(url))
+      return entry and entry['meta']
+
+  def set_meta(self, url, meta):
+    with self._open_index(True) as index:
+      entry = index.get(_hash_contents(url))
+      if entry is not None:
+        entry['meta'] = meta
+
+  def put(self, url, contents, meta):
+    blob = _hash_contents(contents)
+    blob_path = self._get_blob_path(blob)
+    with self._open_index(True) as index:
+      if not os.path.isfile(blob_path):
+        _write_file_atomic(blob_path, contents)
+      index[_hash_contents(url)] = {
+        'url': url, 'blob': blob, 'size': len(contents),
+        'atime': time.time(), 'meta': meta
+      }
+
+  def _evict(self, index):
+    sizes = dict((entry['blob'], entry['size']) for entry in index.values())
+    total = sum(sizes.values())
+    entries = sorted(index.items(), key=lambda item: item[1]['atime'])
+    for key, entry in entries:
+      if total <= self._max_size:
+        break
+      del index[key]
+      if not any(other['blob'] == entry['blob'] for other in index.values()):
+        total -= entry['size']
+        try:
+          os.remove(self._get_blob_path(entry['blob']))
+        except OSError:
+          pass
+
+
+class LocalArtifactCache(object):
+  """An artifact cache stored in a directory, which can be shared by
+     several checkouts.
+  """
+
+  def __init__(self, directory):
+    self._directory = directory
+
+  def _get_path(self, key):
+    return os.path.join(self._directory, key[:2], key)
+
+  def get(self, key):
+    """Return the contents of an artifact, or None if it is missing."""
+    path = self._get_path(key)
+    if os.path.isfile(path):
+      with open(path, 'rb') as f:
+        return f.read()
+    return None
+
+  def put(self, key, contents):
+    _write_file_atomic(self._get_path(key), contents)
+
+
+class HttpArtifactCache(object):
+  """An artifact cache stored by an HTTP server, which reads artifacts with
+     GET <url>/<key> and writes them with PUT <url>/<key>.  Network errors
+     are ignored: the artifacts are then built locally.
+  """
+
+  def __init__(self, url, timeout):
+    self._url = url.rstrip('/') + '/'
+    self._timeout = timeout
+
+  def _request(self, method, key, body=None):
+    parts = urlparse.urlsplit(self._url + key)
+    if parts.scheme == 'https':
+      connection = httplib.HTTPSConnection(parts.netloc, timeout=self._timeout)
+    else:
+      connection = httplib.HTTPConnection(parts.netloc, timeout=self._timeout)
+    try:
+      connection.request(method, parts.path, body)
+      response = connection.getresponse()
+      return response.status, response.read()
+    finally:
+      connection.close()
+
+  def get(self, key):
+    try:
+      status, body = self._request('GET', key)
+    except (socket.error, httplib.HTTPException):
+      return None
+    return body if status == 200 else None
+
+  def put(self, key, contents):
+    try:
+      self._request('PUT', key, contents)
+    except (socket.error, httplib.HTTPException):
+      pass
+
+
+def _get_artifact_cache(parameters):
+  location = parameters[Param.ARTIFACT_CACHE]
+  if not location:
+    return None
+  elif _is_url(location):
+    return HttpArtifactCache(location,
+                             parameters.get_float(Param.DOWNLOAD_TIMEOUT, 30))
+  else:
+    return LocalArtifactCache(location)
+
+
+_TOOL_VERSIONS = {}
+_TOOL_VERSIONS_LOCK = threading.Lock()
+
+
+def _find_command(command):
+  """Return the path of the executable run by command, or None."""
+  if os.path.dirname(command):
+    return command if os.path.isfile(command) else None
+  for directory in os.environ.get('PATH', '').split(os.pathsep):
+    path = os.path.join(directory, command)
+    if os.path.isfile(path) and os.access(path, os.X_OK):
+      return path
+  return None
+
+
+def _get_tool_version(command):
+  """Return the output of 'command --version', or None if it fails.  The
+     version is cached until the executable is modified (e.g. upgraded).
+  """
+  path = _find_command(command)
+  if path is None:
+    return None
+  key = (os.path.realpath(path), os.path.getmtime(os.path.realpath(path)))
+  with _TOOL_VERSIONS_LOCK:
+    if key not in _TOOL_VERSIONS:
+      try:
+        _TOOL_VERSIONS[key] = ''.join(run(path, ['--version'])).strip()
+      except RunError:
+        _TOOL_VERSIONS[key] = None
+    return _TOOL_VERSIONS[key]
+
 
 class UrlFile(File):
   """A source file stored remotely."""
 
-  def __init__(self, path, parameters, type_=None):
+  def __init__(self, path, parameters, type_=None, downloader=None):
     File.__init__(self)
     self._type = type_ or os.path.splitext(path)[1][1:]
-    self._use_wget = parameters[Param.USE_WGET]
-    if parameters[Param.CACHE]:
-      self._path = self._get_cache_path(path, parameters[Param.CACHE_DIR])
-      self._contents = self._read_cache(path,
-                                        self._path,
-                                        parameters[Param.CACHE_DOWNLOAD])
+    self._url = path
+    self._downloader = downloader or Downloader(parameters)
+    self._parameters = parameters
+    self._contents = None
+    self._loaded = False
+    self._cache = None
+    self._copy_from_cache = False
+    if parameters[Param.SHARED_CACHE]:
+      self._cache = SharedCache(
+        parameters[Param.SHARED_CACHE],
+        parameters.get_size(Param.SHARED_CACHE_SIZE, 256 << 20))
+      if parameters.get_bool(Param.CACHE):
+        # Pages in development mode need a copy next to the project.
+        self._copy_from_cache = True
+        self._path = os.path.join(
+          parameters[Param.CACHE_DIR],
+          _hash_contents(path)[:16] + '.' + self._type)
+      else:
+        self._path = path
+    elif parameters.get_bool(Param.CACHE):
+      self._cache = LocalUrlCache(parameters[Param.CACHE_DIR], self._type)
+      self._path = self._cache.get_path(path)
     else:
       self._path = path
-      self._contents = None
+
+  def load(self):
+    """Download the file if it is needed by the build.  This is called
+       by CherryHandler from the download threads.
+    """
+    if self._parameters.get_bool(Param.CLEAN):
+      self._loaded = True
+      return
+    if self._cache is not None:
+      self._contents = (
+        self._read_cache(self._url, self._parameters[Param.CACHE_DOWNLOAD]) or
+        self._cache.read(self._url))
+      if self._copy_from_cache:
+        if (not os.path.isfile(self._path) or
+            FSFile(self._path).read() != self._contents):
+          _write_file_atomic(self._path, self._contents)
+    elif not self._parameters.get_bool(Param.DEV):
+      self.read()
+    self._loaded = True
+
+  def is_loaded(self):
+    return self._loaded
+
+  def get_url(self):
+    return self._url
+
+  def get_id(self):
+    return self._url
 
   def get_type(self):
     return self._type
@@ -243,39 +1176,65 @@ class UrlFile(File):
   def get_path(self):
     return self._path
 
-  def _get_cache_path(self, path, cache_dir):
-    if not os.path.exists(cache_dir):
-      os.makedirs(cache_dir)
-    cache_path = os.path.join(
-      cache_dir, path.replace(':', '_').replace('/', '_').replace('?', '_'))
-    if not cache_path.endswith('.' + self._type):
-      cache_path += '.' + self._type
-    return cache_path
-
-  def _read_cache(self, path, cache_path, cache_download):
+  def _read_cache(self, url, cache_download):
+    """Update the cache entry of url if needed.  Return the downloaded
+       contents, or None if the cached copy is up to date.
+    """
     if cache_download == CacheDownload.LOCAL:
-      if not os.path.isfile(cache_path):
-        raise FatalError('Cannot find file in local cache: ' + path)
+      if not self._cache.exists(url):
+        raise FatalError('Cannot find file in local cache: ' + url)
       return None
     else:
+      # In auto mode, the cached copy is revalidated with the HTTP caching
+      # headers of the previous download.
+      meta = None
+      headers = {}
+      if cache_download == CacheDownload.AUTO and self._cache.exists(url):
+        meta = self._cache.get_meta(url)
+        if meta and time.time() < meta['date'] + meta['max_age']:
+          return None
+        if meta and meta['etag']:
+          headers['If-None-Match'] = meta['etag']
+        if meta and meta['last_modified']:
+          headers['If-Modified-Since'] = meta['last_modified']
       try:
-        contents = read_url(path, self._use_wget)
-        with open(cache_path, 'w') as f:
-          f.write(contents)
-        return contents
+        response = self._downloader.fetch(url, headers)
+        if response.status == 304:
+          self._cache.set_meta(url, dict(
+            meta, date=time.time(),
+            max_age=self._get_max_age(response.headers)))
+          return None
+        self._cache.put(url, response.body, {
+          'date': time.time(),
+          'max_age': self._get_max_age(response.headers),
+          'etag': response.headers.get('etag'),
+          'last_modified': response.headers.get('last-modified')
+        })
+        return response.body
       except urllib2.URLError:
         if (cache_download == CacheDownload.FORCE or
-            not os.path.isfile(cache_path)):
-          raise FatalError('Cannot download file: ' + path)
+            not self._cache.exists(url)):
+          raise FatalError('Cannot download file: ' + url)
         else:
           return None
 
+  def _get_max_age(self, headers):
+    cache_control = headers.get('cache-control', '')
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+      return 0
+    match = re.search(r'max-age=(\d+)', cache_control)
+    return int(match.group(1)) if match else 0
+
   def _read(self, path):
     if _is_url(path):
-      return read_url(path, self._use_wget)
+      try:
+        return self._downloader.read(path)
+      except urllib2.URLError:
+        raise FatalError('Cannot download file: ' + path)
     else:
-      with open(self._path, 'r') as f:
-        return f.read()
+      with _span('read ' + self._path, 'read', path=self._path):
+        with open(self._path, 'r') as f:
+          return f.read()
 
   def read(self):
     if self._contents is None:
@@ -328,6 +1287,71 @@ class Param(object):
   PRETTY = 'pretty'
   LOG_LEVEL = 'log_level'
   USE_WGET = 'use_wget'
+  DOWNLOAD_JOBS = 'download_jobs'
+  DOWNLOAD_TIMEOUT = 'download_timeout'
+  DOWNLOAD_RETRIES = 'download_retries'
+  SHARED_CACHE = 'shared_cache'
+  SHARED_CACHE_SIZE = 'shared_cache_size'
+  MINIFY_PER_FILE = 'minify_per_file'
+  WATCH_INTERVAL = 'watch_interval'
+  WATCH_DEBOUNCE = 'watch_debounce'
+  DEV_BUNDLE = 'dev_bundle'
+  SOURCE_MAP = 'source_map'
+  HASH_NAMES = 'hash_names'
+  HASH_KEEP = 'hash_keep'
+  COMPRESS = 'compress'
+  COMPRESS_LEVEL = 'compress_level'
+  SERVE = 'serve'
+  SERVE_HOST = 'serve_host'
+  SERVE_PORT = 'serve_port'
+  INLINE_MAX_SIZE = 'inline_max_size'
+  SIZE_REPORT = 'size_report'
+  ARTIFACT_CACHE = 'artifact_cache'
+
+
+class Parameters(dict):
+  """The parameters of a build, indexed by the Param names.  Unset
+     parameters are None.  Values set with -s are strings, and are converted
+     by the get_* methods.
+  """
+
+  def __missing__(self, name):
+    return None
+
+  def copy(self):
+    return Parameters(self)
+
+  def _get(self, name, default, convert):
+    value = self[name]
+    if value is None or value == '':
+      return default
+    try:
+      return convert(value)
+    except ValueError:
+      raise FatalError('Invalid value for parameter %s: %s' % (name, value))
+
+  def get_bool(self, name):
+    """Return a flag, which may be set to 0, 1, false or true (or no, yes,
+       off, on) with -s.
+    """
+    value = self[name]
+    if value is None or isinstance(value, bool):
+      return bool(value)
+    if str(value).lower() in ('1', 'true', 'yes', 'on'):
+      return True
+    if str(value).lower() in ('', '0', 'false', 'no', 'off'):
+      return False
+    raise FatalError('Invalid value for parameter %s: %s' % (name, value))
+
+  def get_int(self, name, default=None):
+    return self._get(name, default, int)
+
+  def get_float(self, name, default=None):
+    return self._get(name, default, float)
+
+  def get_size(self, name, default=None):
+    """Return a size in bytes, which may have a k, M or G suffix."""
+    return self._get(name, default, lambda value: _parse_size(str(value)))
 
 
 class CacheDownload(object):
@@ -336,6 +1360,9 @@ class CacheDownload(object):
   AUTO = 'auto'
 
 
+_LOG_LOCK = threading.Lock()
+
+
 class LogLevel(object):
   QUIET = 1
   DEFAULT = 2
@@ -347,17 +1374,60 @@ class Handler(object):
   def __init__(self, output, parameters):
     self._parameters = parameters
     self._output = output
-    self._clean = self._parameters[Param.CLEAN]
-    self._dev = self._parameters[Param.DEV]
-    self._pretty = self._parameters[Param.PRETTY]
+    self._clean = self._parameters.get_bool(Param.CLEAN)
+    self._dev = self._parameters.get_bool(Param.DEV)
+    self._pretty = self._parameters.get_bool(Param.PRETTY)
     self._log_level = self._parameters[Param.LOG_LEVEL] or LogLevel.DEFAULT
+    self._artifact_cache = _get_artifact_cache(self._parameters)
+    self._dependencies = []
+    self._outputs = []
+
+  def reset(self):
+    """Called before every build, to forget the files of the previous
+       build.
+    """
+    self._dependencies = []
+
+  def get_dependencies(self):
+    """Return the paths of the files used by the handler which are not
+       part of the handled files (e.g. runtime libraries).
+    """
+    return self._dependencies
+
+  def get_outputs(self):
+    """Return the paths of the files generated by the last finalize()."""
+    return self._outputs
 
   def handle(self, zfile, stack):
     raise NotImplementedError
 
+  def prepare(self):
+    """Called on every handler once all files have been handled, and
+       before any handler is finalized.
+    """
+    pass
+
   def finalize(self):
     raise NotImplementedError
 
+  def get_file_sizes(self):
+    """Return the path of the bundle generated by the last finalize(), and
+       the list of the name, size and minified code of its files, or None
+       if the handler does not generate a bundle.
+    """
+    return None
+
+  def _get_source(self, zfile):
+    """Return the name of a file in reports and source maps."""
+    if isinstance(zfile, UrlFile):
+      return zfile.get_url()
+    return zfile.get_path()
+
+  # Files outside of the output directory (e.g. soyutils.js) are copied
+  # next to the output as <name>.dev.<ext>.  Copies are only written when
+  # their source has changed, and a manifest records that they have been
+  # created by cherry, so that --clean does not remove other files.
+
   def _get_rel_path_internal(self, path, create):
     outdir = os.path.dirname(self._output)
     rel_path = _get_relative_sub_path(path, outdir)
@@ -367,7 +1437,11 @@ class Handler(object):
       name, ext = os.path.splitext(os.path.basename(path))
       filename = name + '.dev' + ext
       if create:
-        shutil.copyfile(path, os.path.join(outdir, filename))
+        copy_path = os.path.join(outdir, filename)
+        if _sync_file(path, copy_path):
+          self._log(LogLevel.VERBOSE, 'Copying %s to %s' % (path, copy_path))
+        if not os.path.isfile(_get_manifest_path(copy_path)):
+          self._write_manifest(copy_path, {'source': path})
       return True, filename
 
   def _get_sub_path(self, path):
@@ -377,7 +1451,10 @@ class Handler(object):
   def _clean_sub_path(self, path):
     copy, sub_path = self._get_rel_path_internal(path, False)
     if copy:
-      self._remove_if_exists(sub_path)
+      copy_path = os.path.join(os.path.dirname(self._output), sub_path)
+      if os.path.isfile(_get_manifest_path(copy_path)):
+        self._remove_if_exists(copy_path)
+        self._remove_manifest(copy_path)
 
   def _log(self, arg1, arg2=None):
     if arg2 is None:
@@ -386,18 +1463,103 @@ class Handler(object):
       level = arg1
       message = arg2
       if level <= self._log_level:
-        print message
+        with _LOG_LOCK:
+          sys.stdout.write(message + '\n')
 
   def _run(self, command, arguments=[], inputs=[]):
     self._log(LogLevel.VERBOSE,
               'Running command: %s %s' % (command, ' '.join(arguments)))
-    run(command, arguments, inputs)
+    stdout, stats = run_with_stats(command, arguments, inputs)
+    self._log(LogLevel.VERBOSE, 'Command %s: %s' % (command, stats))
+    return stdout
 
   def _remove_if_exists(self, path):
     if os.path.isfile(path):
       self._log(LogLevel.VERBOSE, 'Removing file: %s' % path)
       os.remove(path)
 
+  # Build manifests: a manifest is stored next to each output, and records
+  # the command line used to generate it and the hashes of its inputs.  When
+  # they are unchanged and the output still exists, the command is skipped.
+  # A manifest can also record the hashes of assets found while generating
+  # the output, which must be unchanged as well.
+
+  def _get_build_key(self, command, arguments, files):
+    return {
+      'command': [command] + arguments,
+      'inputs': [[zfile.get_path(), zfile.get_hash()] for zfile in files]
+    }
+
+  def _is_up_to_date(self, out_path, key):
+    manifest_path = _get_manifest_path(out_path)
+    if not (os.path.isfile(out_path) and os.path.isfile(manifest_path)):
+      return False
+    try:
+      with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    except ValueError:
+      return False
+    assets = manifest.pop('assets', [])
+    return manifest == key and all(
+      os.path.isfile(path) and _hash_file(path) == file_hash
+      for path, file_hash in assets)
+
+  def _get_manifest_assets(self, out_path):
+    """Return the paths of the assets recorded by a manifest."""
+    try:
+      with open(_get_manifest_path(out_path), 'r') as f:
+        return [path for path, _ in json.load(f).get('assets', [])]
+    except (IOError, ValueError):
+      return []
+
+  def _write_manifest(self, out_path, key, assets=[]):
+    if assets:
+      key = dict(key, assets=assets)
+    with open(_get_manifest_path(out_path), 'w') as f:
+      json.dump(key, f)
+
+  def _remove_manifest(self, out_path):
+    self._remove_if_exists(_get_manifest_path(out_path))
+
+  # Artifact cache: the files generated by a command are stored in the
+  # artifact cache (--artifact-cache), under keys computed from the build key
+  # and the version of the command, so that other checkouts can fetch them
+  # instead of running the command.
+
+  def _get_artifact_keys(self, command, key, out_paths):
+    if self._artifact_cache is None:
+      return None
+    version = _get_tool_version(command)
+    if version is None:
+      return None
+    return [_hash_contents(json.dumps([version, key, i], sort_keys=True))
+            for i in range(len(out_paths))]
+
+  def _fetch_artifacts(self, command, key, out_paths):
+    """Write the files generated by a command from the artifact cache.
+       Return False if they are not all in the cache.
+    """
+    keys = self._get_artifact_keys(command, key, out_paths)
+    if keys is None:
+      return False
+    artifacts = []
+    for artifact_key in keys:
+      contents = self._artifact_cache.get(artifact_key)
+      if contents is None:
+        return False
+      artifacts.append(contents)
+    for out_path, contents in zip(out_paths, artifacts):
+      _write_file_atomic(out_path, contents)
+    self._log('Fetched from artifact cache: %s' % ' '.join(out_paths))
+    return True
+
+  def _store_artifacts(self, command, key, out_paths):
+    keys = self._get_artifact_keys(command, key, out_paths)
+    if keys is not None and all(os.path.isfile(path) for path in out_paths):
+      for artifact_key, out_path in zip(keys, out_paths):
+        with open(out_path, 'rb') as f:
+          self._artifact_cache.put(artifact_key, f.read())
+
 
 class JavaScriptHandler(Handler):
 
@@ -406,40 +1568,221 @@ class JavaScriptHandler(Handler):
   def __init__(self, *args, **kwargs):
     Handler.__init__(self, *args, **kwargs)
     self._files = []
+    self._per_file = self._parameters.get_bool(Param.MINIFY_PER_FILE)
+    self._dev_bundle = self._parameters.get_bool(Param.DEV_BUNDLE)
+    self._source_map = self._parameters.get_bool(Param.SOURCE_MAP)
+    self._cache_dir = self._parameters['minify_cache_dir']
+    if not self._cache_dir and self._parameters[Param.CACHE_DIR]:
+      self._cache_dir = os.path.join(
+        self._parameters[Param.CACHE_DIR], 'uglifyjs')
+
+  def reset(self):
+    Handler.reset(self)
+    self._files = []
 
   def handle(self, zfile, statck):
     self._files.append(zfile)
 
+  def _get_index_path(self, out_path):
+    """The index of a development bundle gives the first line of every
+       source file in the bundle.
+    """
+    return out_path + '.index.json'
+
   def finalize(self):
     out_path = self._output + '.js'
+    self._outputs = []
     if self._clean:
       self._remove_if_exists(out_path)
+      self._remove_if_exists(out_path + '.map')
+      self._remove_manifest(out_path)
+      self._remove_if_exists(self._get_index_path(out_path))
     elif self._dev:
       self._log('Generating: %s' % out_path)
+      self._remove_manifest(out_path)
+      self._outputs.append(out_path)
+      chunks = []
+      def add(chunk):
+        chunks.append(chunk)
+        add.lines += chunk.count('\n')
+      add.lines = 0
+      add(_JS_RUNTIME_START)
+      add('cherry.set_base_url(%s);\n' %
+          json.dumps(os.path.basename(out_path)))
+      if self._parameters.get_bool(Param.SERVE):
+        add('cherry.live_reload(%s);\n' %
+            json.dumps(_DevServer.EVENTS_PATH))
+      sources = []
+      for zfile in self._files:
+        path = zfile.get_path()
+        if path is None:
+          add(zfile.read())
+        elif self._dev_bundle:
+          # Every file is evaluated in the global scope from a single line,
+          # and the sourceURL gives its name to the debugger.  The
+          # declarations of strict code stay local to an indirect eval, so
+          # strict files are run as inline scripts.
+          contents = zfile.read()
+          sources.append({'line': add.lines + 1, 'path': path})
+          add('%s(%s);\n' % (
+            'cherry.eval_script' if _JS_USE_STRICT.match(contents)
+            else '(0, eval)',
+            json.dumps(_decode_source(contents) + '\n//# sourceURL=' + path)))
+        else:
+          add('cherry.include_js(%s);\n' % json.dumps(path))
+      chunks.append(_JS_RUNTIME_END)
       with open(out_path, 'w') as out:
-        out.write(_JS_RUNTIME_START)
-        out.write('cherry.set_base_url(%s);\n' %
-                  json.dumps(os.path.basename(out_path)))
-        for zfile in self._files:
-          path = zfile.get_path()
-          if path is None:
-            out.write(zfile.read())
-          else:
-            out.write('cherry.include_js(%s);\n' % json.dumps(path))
-        out.write(_JS_RUNTIME_END)
+        for chunk in chunks:
+          out.write(chunk)
+      if self._dev_bundle:
+        with open(self._get_index_path(out_path), 'w') as out:
+          json.dump({'file': os.path.basename(out_path),
+                     'sources': sources}, out, indent=1, sort_keys=True)
+      else:
+        self._remove_if_exists(self._get_index_path(out_path))
     else:
       if self._files:
-        self._log('Minifying JavaScript: %s' % out_path)
-        # -nm for compatibility with AngularJS
-        options = ['--output', out_path, '-nm', '-nc']
+        self._outputs.append(out_path)
+        map_path = out_path + '.map'
+        if self._source_map:
+          # Source maps require UglifyJS 2 (-s uglifyjs2=COMMAND), which
+          # reads the files itself, and does not mangle names by default.
+          # The files are added to the options when running it.
+          options = [
+            '--output', out_path,
+            '-c',
+            '--source-map', map_path,
+            '--source-map-url', os.path.basename(map_path),
+            '--source-map-include-sources']
+          command = self._parameters['uglifyjs2'] or 'uglifyjs'
+          self._outputs.append(map_path)
+        else:
+          # -nm for compatibility with AngularJS
+          options = ['--output', out_path, '-nm', '-nc']
+          command = self._parameters['uglifyjs'] or 'uglifyjs'
         if self._pretty:
           options.append('--beautify')
-        self._run(self._parameters['uglifyjs'] or 'uglifyjs',
-                  options, [zfile.read() for zfile in self._files])
-        return
-        with open(out_path, 'w') as outf:
-          for zfile in self._files:
-            outf.write(zfile.read())
+        key = self._get_build_key(command, options, self._files)
+        key['per_file'] = bool(self._per_file)
+        if self._is_up_to_date(out_path, key):
+          self._log('Up to date: %s' % out_path)
+          return
+        self._remove_manifest(out_path)
+        if not self._fetch_artifacts(command, key, self._outputs):
+          self._log('Minifying JavaScript: %s' % out_path)
+          if self._source_map:
+            tmp_dir = tempfile.mkdtemp(prefix='cherry-')
+            try:
+              sources = self._get_source_files(out_path, tmp_dir)
+              self._run(command, [path for path, _ in sources] + options, [])
+              self._compose_source_map(map_path, sources)
+            finally:
+              shutil.rmtree(tmp_dir, True)
+          elif self._per_file and self._cache_dir:
+            self._minify_per_file(command, options[2:], out_path)
+          else:
+            self._run(command, options,
+                      (zfile.open() for zfile in self._files))
+          self._store_artifacts(command, key, self._outputs)
+        self._write_manifest(out_path, key)
+
+  def _get_source_files(self, out_path, tmp_dir):
+    """Return, for every file, a path from which uglifyjs can read it and
+       the name of the file in the source map.  Files which are not stored
+       locally are written to tmp_dir.
+    """
+    outdir = os.path.dirname(os.path.abspath(out_path))
+    sources = []
+    for i, zfile in enumerate(self._files):
+      path = zfile.get_path()
+      if isinstance(zfile, UrlFile):
+        name = zfile.get_url()
+      elif path is None:
+        name = 'inline-%d.js' % i
+      else:
+        sources.append((path, os.path.relpath(path, outdir)))
+        continue
+      if path is None or _is_url(path):
+        path = os.path.join(tmp_dir, 'source-%d.js' % i)
+        with open(path, 'wb') as f:
+          f.write(zfile.read())
+      sources.append((path, name))
+    return sources
+
+  def _compose_source_map(self, map_path, sources):
+    """Rename the sources of the map generated by uglifyjs, and compose it
+       with the source maps of the input files.
+    """
+    outdir = os.path.dirname(os.path.abspath(map_path))
+    names = dict(sources)
+    with open(map_path, 'r') as f:
+      source_map = json.load(f)
+    source_names = []
+    input_maps = {}
+    for i, source in enumerate(source_map['sources']):
+      source_names.append(names.get(source, source))
+      if source in names and os.path.isfile(source):
+        input_map = _read_input_source_map(
+          source, FSFile(source).read(), outdir)
+        if input_map:
+          input_maps[i] = input_map
+    _write_file_atomic(map_path, json.dumps(
+      _compose_source_maps(source_map, source_names, input_maps)))
+
+  def get_file_sizes(self):
+    if self._clean or self._dev or not self._files:
+      return None
+    command = self._parameters['uglifyjs'] or 'uglifyjs'
+    pieces = self._minify_files(command, ['-nm', '-nc'])
+    return self._output + '.js', [
+      (self._get_source(zfile) or '<inline>', len(zfile.read()),
+       piece.strip())
+      for zfile, piece in zip(self._files, pieces)]
+
+  def _minify_files(self, command, options):
+    """Minify every file separately, and return the list of the minified
+       codes.  The minified code of the files is kept in the cache directory
+       if there is one.
+    """
+    keys = [_hash_contents('\0'.join([command] + options + [zfile.read()]))
+            for zfile in self._files]
+    def get_cache_path(key):
+      return os.path.join(self._cache_dir, key + '.js')
+    misses = [(zfile, key) for zfile, key in zip(self._files, keys)
+              if not (self._cache_dir and os.path.isfile(get_cache_path(key)))]
+    self._log(LogLevel.VERBOSE, 'Minification cache: %d hits, %d misses' %
+              (len(keys) - len(misses), len(misses)))
+    minified = {}
+    def minify(miss):
+      zfile, key = miss
+      minified[key] = ''.join(self._run(command, options, [zfile.open()]))
+      if self._cache_dir:
+        _write_file_atomic(get_cache_path(key), minified[key])
+    if misses:
+      pool = multiprocessing.pool.ThreadPool(multiprocessing.cpu_count())
+      try:
+        pool.map(minify, misses)
+      finally:
+        pool.close()
+    for key in keys:
+      if key not in minified:
+        with open(get_cache_path(key), 'r') as f:
+          minified[key] = f.read()
+    return [minified[key] for key in keys]
+
+  def _minify_per_file(self, command, options, out_path):
+    """Minify every file separately, reusing the minified code of the
+       files which are in the cache, and concatenate the results.  Unlike
+       the minification of the whole bundle, this starts every file on a new
+       line, and terminates it by a semicolon.
+    """
+    pieces = []
+    for piece in self._minify_files(command, options):
+      piece = piece.strip()
+      if piece and not piece.endswith(';'):
+        piece += '\n;'
+      pieces.append(piece + '\n')
+    _write_file_atomic(out_path, ''.join(pieces))
 
 register_handler(JavaScriptHandler)
 
@@ -447,45 +1790,124 @@ register_handler(JavaScriptHandler)
 class SoyHandler(Handler):
 
   file_types = ['soy']
+  _CODE_STYLE = 'stringbuilder'
+  _OUTPUT_PATH_FORMAT = '{INPUT_DIRECTORY}/{INPUT_FILE_NAME}.js'
 
   def __init__(self, *args, **kwargs):
     Handler.__init__(self, *args, **kwargs)
     self._has_soy = False
+    self._templates = []
     self._soy_dir = self._parameters['soy_dir'] or '/opt/soy'
     self._soyutils_path = os.path.join(self._soy_dir, 'soyutils.js')
+    self._compiler_path = os.path.join(self._soy_dir, 'SoyToJsSrcCompiler.jar')
+    self._compiler_hash = None
     self._java = self._parameters['java'] or 'java'
+    self._cache_dir = self._parameters['soy_cache_dir']
+    if not self._cache_dir and self._parameters[Param.CACHE_DIR]:
+      self._cache_dir = os.path.join(self._parameters[Param.CACHE_DIR], 'soy')
+
+  def reset(self):
+    Handler.reset(self)
+    self._has_soy = False
+    self._templates = []
 
   def handle(self, zfile, stack):
-    r = []
-    stack.append(self._compile(zfile))
+    # Templates are compiled all together in prepare(), before the
+    # generated files are read by the other handlers.
+    self._templates.append(zfile)
+    stack.append(FSFile(zfile.get_path() + '.js', generated=True))
     if not self._has_soy:
       self._has_soy = True
+      self._dependencies.append(self._soyutils_path)
       stack.append(
-        FSFile(self._get_sub_path(self._soyutils_path)))
+        FSFile(self._get_sub_path(self._soyutils_path), generated=True))
 
   def _get_out_path(self):
     out_path = self._output + '.js'
 
-  def _compile(self, zfile):
-    outpath = zfile.get_path() + '.js'
+  def prepare(self):
+    self._outputs = []
     if self._clean:
-      self._remove_if_exists(outpath)
-      self._clean_sub_path(self._soyutils_path)
-    else:
-      self._log('Compiling Closure Templates: %s' % zfile.get_path())
+      for zfile in self._templates:
+        self._remove_if_exists(zfile.get_path() + '.js')
+      if self._has_soy:
+        self._clean_sub_path(self._soyutils_path)
+    elif self._templates:
+      self._compile(self._templates)
+      self._outputs = [zfile.get_path() + '.js' for zfile in self._templates]
+
+  # Compilation cache: the generated code for a template is stored under a
+  # key computed from the template contents, the compiler and its options,
+  # in the cache directory and in the artifact cache.
+
+  def _get_cache_key(self, zfile):
+    if self._compiler_hash is None:
+      self._compiler_hash = _hash_file(self._compiler_path)
+    return _hash_contents('\0'.join([
+      self._compiler_hash, self._CODE_STYLE, self._OUTPUT_PATH_FORMAT,
+      zfile.read()]))
+
+  def _get_cache_path(self, key):
+    return os.path.join(self._cache_dir, key + '.js')
+
+  def _read_cache(self, key):
+    if self._cache_dir:
+      cache_path = self._get_cache_path(key)
+      if os.path.isfile(cache_path):
+        with open(cache_path, 'r') as f:
+          return f.read()
+    if self._artifact_cache is not None:
+      contents = self._artifact_cache.get(key)
+      if contents is not None and self._cache_dir:
+        _write_file_atomic(self._get_cache_path(key), contents)
+      return contents
+    return None
+
+  def _write_cache(self, key, contents):
+    if self._cache_dir:
+      _write_file_atomic(self._get_cache_path(key), contents)
+    if self._artifact_cache is not None:
+      self._artifact_cache.put(key, contents)
+
+  def _compile(self, zfiles):
+    misses = []
+    hits = 0
+    use_cache = ((self._cache_dir or self._artifact_cache is not None) and
+                 os.path.isfile(self._compiler_path))
+    for zfile in zfiles:
+      key = self._get_cache_key(zfile) if use_cache else None
+      contents = self._read_cache(key) if key else None
+      if contents is None:
+        misses.append((zfile, key))
+      else:
+        hits += 1
+        outpath = zfile.get_path() + '.js'
+        if (not os.path.isfile(outpath) or
+            FSFile(outpath).read() != contents):
+          _write_file_atomic(outpath, contents)
+    if use_cache:
+      self._log('Closure Templates cache: %d hits, %d misses' %
+                (hits, len(misses)))
+    if not misses:
+      return
+    self._log('Compiling Closure Templates: %s' %
+              ' '.join(zfile.get_path() for zfile, _ in misses))
+    paths = []
+    for zfile, _ in misses:
       path = zfile.get_path()
       # This is to work around a bug of soy compiler.
       if not os.path.dirname(path):
         path = os.path.join('.', path)
-      self._run(self._java, [
-        '-jar',
-        os.path.join(self._soy_dir, 'SoyToJsSrcCompiler.jar'),
-        '--codeStyle', 'stringbuilder',
-        '--outputPathFormat',
-        '{INPUT_DIRECTORY}/{INPUT_FILE_NAME}.js',
-        path
-      ], [])
-    return FSFile(outpath)
+      paths.append(path)
+    self._run(self._java, [
+      '-jar',
+      self._compiler_path,
+      '--codeStyle', self._CODE_STYLE,
+      '--outputPathFormat', self._OUTPUT_PATH_FORMAT
+    ] + paths, [])
+    for zfile, key in misses:
+      if key:
+        self._write_cache(key, FSFile(zfile.get_path() + '.js').read())
 
   def finalize(self):
     pass
@@ -497,18 +1919,56 @@ class CssHandler(Handler):
 
   file_types = ['css', 'less']
   _LESS_JS_RUNTIME = '/usr/share/javascript/less/less.min.js'
+  # MIME types of the inlined assets, which are not all known by mimetypes.
+  _MIME_TYPES = {
+    '.eot': 'application/vnd.ms-fontobject',
+    '.otf': 'font/otf',
+    '.svg': 'image/svg+xml',
+    '.ttf': 'font/ttf',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2'
+  }
+  _IMPORT = re.compile(
+    r'@import\s*(?:\([^)]*\)\s*)?(?:url\(\s*)?(["\']?)([^"\')\s;]+)\1',
+    re.IGNORECASE)
 
   def __init__(self, *args, **kwargs):
     Handler.__init__(self, *args, **kwargs)
     self._files = []
     self._has_less = False
+    self._has_import = False
+    self._imports = []
+    # The inlined assets are kept until the next finalize(), which may be
+    # skipped by --watch.
+    self._assets = []
     self._less_js = self._parameters['less.js'] or self._LESS_JS_RUNTIME
+    self._inline_max_size = self._parameters.get_size(Param.INLINE_MAX_SIZE, 0)
+
+  def reset(self):
+    Handler.reset(self)
+    self._files = []
+    self._has_less = False
+    self._has_import = False
+    self._imports = []
+
+  def get_dependencies(self):
+    return self._dependencies + self._assets
 
   def handle(self, zfile, stack):
+    # The imports only matter to the build, and remote stylesheets are
+    # not downloaded by --dev and --clean.
+    if self._dev or self._clean:
+      pass
+    elif isinstance(zfile, FSFile):
+      self._add_imports(zfile.get_path())
+    elif '@import' in zfile.read():
+      self._has_import = True
     if zfile.get_type() == 'less' and not self._has_less:
       self._has_less = True
       if self._dev:
-        stack.insert(0, FSFile(self._get_sub_path(self._less_js)))
+        self._dependencies.append(self._less_js)
+        stack.insert(0, FSFile(self._get_sub_path(self._less_js),
+                               generated=True))
     if self._dev:
       stack.append(IncludeFile(zfile.get_type(), zfile.get_path()))
     else:
@@ -516,19 +1976,168 @@ class CssHandler(Handler):
 
   def finalize(self):
     out_path = self._output + '.css'
+    self._outputs = []
+    self._assets = []
     if self._clean:
       self._remove_if_exists(out_path)
+      self._remove_if_exists(out_path + '.map')
+      self._remove_manifest(out_path)
       if self._has_less:
         self._clean_sub_path(self._less_js)
     elif self._dev:
       self._remove_if_exists(out_path)
+      self._remove_manifest(out_path)
+    elif self._files and self._can_process_in_python():
+      self._outputs.append(out_path)
+      key = self._get_css_build_key(
+        'cherry', ['css', 'pretty' if self._pretty else 'minify'])
+      if self._is_up_to_date(out_path, key):
+        self._log('Up to date: %s' % out_path)
+        self._assets = self._get_manifest_assets(out_path)
+        return
+      self._log('Writing CSS stylesheet: %s' % out_path)
+      self._remove_manifest(out_path)
+      self._remove_if_exists(out_path + '.map')
+      outdir = os.path.dirname(out_path)
+      _write_file_atomic(out_path, '\n'.join(
+        _process_css(zfile.read(), self._get_source(zfile), outdir,
+                     not self._pretty)
+        for zfile in self._files) + '\n')
+      self._write_manifest(out_path, key, self._inline_assets(out_path))
     else:
       if self._files:
+        self._outputs.append(out_path)
         inputs = ['@import "%s";' % zfile.get_path()
                   for zfile in self._files]
-        self._log('Compiling CSS stylesheet: %s' % out_path)
         options = ['-', out_path]
-        self._run(self._parameters['lessc'] or 'lessc', options, inputs)
+        if self._parameters.get_bool(Param.SOURCE_MAP):
+          map_path = out_path + '.map'
+          options[:0] = ['--source-map=' + map_path,
+                         '--source-map-url=' + os.path.basename(map_path)]
+          self._outputs.append(map_path)
+        command = self._parameters['lessc'] or 'lessc'
+        key = self._get_css_build_key(command, options)
+        if self._is_up_to_date(out_path, key):
+          self._log('Up to date: %s' % out_path)
+          self._assets = self._get_manifest_assets(out_path)
+          return
+        self._remove_manifest(out_path)
+        if not self._fetch_artifacts(command, key, self._outputs):
+          self._log('Compiling CSS stylesheet: %s' % out_path)
+          self._run(command, options, inputs)
+          self._store_artifacts(command, key, self._outputs)
+        self._write_manifest(out_path, key, self._inline_assets(out_path))
+
+  def _add_imports(self, path):
+    """Record the local files imported by a stylesheet, recursively.  They
+       are dependencies of the handler, and inputs of the build manifest.
+    """
+    if not os.path.isfile(path):
+      raise FatalError('Cannot find stylesheet: ' + path)
+    with open(path, 'r') as f:
+      contents = f.read()
+    for match in self._IMPORT.finditer(contents):
+      self._has_import = True
+      import_path = match.group(2)
+      if _is_url(import_path) or os.path.isabs(import_path):
+        continue
+      import_path = os.path.normpath(
+        os.path.join(os.path.dirname(path), import_path))
+      # LESS adds the .less extension to imports without extension.
+      if path.endswith('.less') and not os.path.splitext(import_path)[1]:
+        import_path += '.less'
+      if os.path.isfile(import_path) and import_path not in self._imports:
+        self._imports.append(import_path)
+        self._dependencies.append(import_path)
+        self._add_imports(import_path)
+
+  def _get_css_build_key(self, command, options):
+    key = self._get_build_key(command, options, self._files)
+    if self._imports:
+      key['imports'] = [[path, _hash_file(path)] for path in self._imports]
+    if self._inline_max_size:
+      key['inline_max_size'] = self._inline_max_size
+    return key
+
+  # Inlining: the url() of the stylesheet referring to small local files are
+  # replaced with data URIs, cached by file hash in the cache directory.
+  # Inlining is disabled with source maps, whose columns would be wrong.
+
+  def _inline_assets(self, out_path):
+    """Inline the small assets of the stylesheet out_path.  Return the list
+       of the paths and hashes of the inlined assets, to be recorded in the
+       build manifest.
+    """
+    if (not self._inline_max_size or
+        self._parameters.get_bool(Param.SOURCE_MAP)):
+      return []
+    outdir = os.path.dirname(out_path)
+    assets = {}
+    def replace_url(match):
+      url = match.group(3)
+      if url is None:
+        return match.group()
+      quote = url[0] if url[:1] in ('"', "'") else ''
+      if quote:
+        url = url[1:-1]
+      if (not url or re.match(r'^([a-zA-Z][a-zA-Z0-9+.-]*:|/|#)', url) or
+          '?' in url):
+        return match.group()
+      path, _, fragment = url.partition('#')
+      path = os.path.normpath(os.path.join(outdir, urllib2.unquote(path)))
+      mime_type = (self._MIME_TYPES.get(os.path.splitext(path)[1].lower()) or
+                   mimetypes.guess_type(path)[0])
+      if (mime_type is None or not os.path.isfile(path) or
+          os.path.getsize(path) > self._inline_max_size):
+        return match.group()
+      data_uri, assets[path] = self._get_data_uri(path, mime_type)
+      return 'url(%s%s%s%s)' % (quote, data_uri, '#' if fragment else '',
+                                fragment)
+    with open(out_path, 'r') as f:
+      contents = _CSS_TOKENS.sub(replace_url, f.read())
+    self._assets = sorted(assets)
+    if assets:
+      _write_file_atomic(out_path, contents)
+      self._log('Inlined %d assets (%d bytes) in %s' % (
+        len(assets), sum(os.path.getsize(path) for path in assets),
+        out_path))
+    return sorted([path, file_hash] for path, file_hash in assets.items())
+
+  def _get_data_uri(self, path, mime_type):
+    """Return the data URI of a file, and the hash of the file."""
+    file_hash = _hash_file(path)
+    cache_path = None
+    if self._parameters[Param.CACHE_DIR]:
+      cache_path = os.path.join(self._parameters[Param.CACHE_DIR], 'inline',
+                                _hash_contents(file_hash + mime_type))
+      if os.path.isfile(cache_path):
+        with open(cache_path, 'r') as f:
+          return f.read(), file_hash
+    with open(path, 'rb') as f:
+      data_uri = 'data:%s;base64,%s' % (mime_type, base64.b64encode(f.read()))
+    if cache_path is not None:
+      _write_file_atomic(cache_path, data_uri)
+    return data_uri, file_hash
+
+  def _can_process_in_python(self):
+    """Return True if the stylesheet is made of plain CSS files, which can
+       be concatenated without running lessc.  lessc is still needed to
+       inline @import rules and to generate source maps.
+    """
+    return not (self._has_less or self._has_import or
+                self._parameters.get_bool(Param.SOURCE_MAP))
+
+  def get_file_sizes(self):
+    # LESS files are minified as plain CSS, which gives an estimate of
+    # their contribution to the stylesheet.
+    if self._clean or self._dev or not self._files:
+      return None
+    out_path = self._output + '.css'
+    outdir = os.path.dirname(out_path)
+    return out_path, [
+      (self._get_source(zfile), len(zfile.read()),
+       _process_css(zfile.read(), self._get_source(zfile), outdir, True))
+      for zfile in self._files]
 
 
 register_handler(CssHandler)
@@ -540,25 +2149,52 @@ class CherryHandler(Handler):
 
   def __init__(self, *args, **kwargs):
     Handler.__init__(self, *args, **kwargs)
-    self._cache = self._parameters[Param.CACHE]
+    self._cache = self._parameters.get_bool(Param.CACHE)
+    self._downloader = Downloader(self._parameters)
+    # Remote files are kept from one build to the next (see --watch).
+    self._url_files = {}
+    self._budgets = {}
+
+  def reset(self):
+    Handler.reset(self)
+    self._budgets = {}
+
+  def get_budgets(self):
+    """Return the size budgets set by the manifests, with lines like
+       '#budget: js=300k js.file=100k'.
+    """
+    return self._budgets
 
   def handle(self, zfile, stack):
     base = os.path.dirname(zfile.get_path())
     result = []
     for line in reversed(zfile.read().splitlines()):
-      if line and not line.startswith('#'):
+      if line.startswith('#budget:'):
+        for entry in line[len('#budget:'):].split():
+          name, _, value = entry.partition('=')
+          self._budgets.setdefault(name, _parse_size(value))
+      elif line and not line.startswith('#'):
         parts = line.split(' ', 1)
         path = parts[0]
         type_ = parts[1] if len(parts) == 2 else None
         if _is_url(path):
-          stack.append(UrlFile(path, self._parameters, type_))
+          if (path, type_) not in self._url_files:
+            self._url_files[path, type_] = UrlFile(
+              path, self._parameters, type_, self._downloader)
+          result.append(self._url_files[path, type_])
         else:
           if not os.path.isabs(path):
             path = os.path.join(base, path)
-          stack.append(FSFile(path, type_))
+          result.append(FSFile(path, type_))
+    # Download all the remote files of the manifest at the same time.
+    self._downloader.map(lambda zfile: zfile.load(),
+                         [zfile for zfile in set(result)
+                          if isinstance(zfile, UrlFile) and
+                          not zfile.is_loaded()])
+    stack.extend(result)
 
   def finalize(self):
-    pass
+    self._downloader.close()
 
 
 register_handler(CherryHandler)
@@ -567,12 +2203,72 @@ register_handler(CherryHandler)
 # *************************************************************************
 # Class Cherry
 
+class BuildResult(object):
+  """The result of Cherry.handle().
+
+     outputs maps the path of every generated file to its contents,
+     dependencies is the list of the source files, and timings maps the
+     name of every finalized handler, and 'total', to a duration in
+     seconds.
+  """
+
+  def __init__(self, outputs, dependencies, timings):
+    self.outputs = outputs
+    self.dependencies = dependencies
+    self.timings = timings
+
+  def __repr__(self):
+    return 'BuildResult(%s)' % ', '.join(sorted(self.outputs))
+
+
+class MemorySink(object):
+  """An output sink keeping the generated files in the files dictionary,
+     indexed by their path relative to the output directory.
+  """
+
+  def __init__(self):
+    self.files = {}
+
+  def write(self, path, contents):
+    self.files[path] = contents
+
+
+class DirectorySink(object):
+  """An output sink copying the generated files to a directory."""
+
+  def __init__(self, directory):
+    self._directory = directory
+
+  def write(self, path, contents):
+    path = os.path.join(self._directory, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    _write_file_atomic(path, contents)
+
+
 class Cherry(object):
+  """Build the output of a manifest.
+
+     parameters is a Parameters object or a dictionary indexed by the Param
+     names.  The object keeps the state of its handlers between calls to
+     handle(), so that a long-running process only rebuilds what has
+     changed.
+  """
+
+  _HASH_LENGTH = 12
+  _END_OF_MANIFEST = object()
 
   def __init__(self, output, parameters):
+    if not isinstance(parameters, Parameters):
+      parameters = Parameters(parameters)
     self._build_handlers(output, parameters)
-    self._cache_clean = parameters[Param.CACHE_CLEAN]
+    self._output = output
+    self._parameters = parameters
+    self._cache_clean = parameters.get_bool(Param.CACHE_CLEAN)
     self._cache_dir = parameters[Param.CACHE_DIR]
+    self._dependencies = collections.OrderedDict()
+    self._snapshot = {}
+    self._finalized_stamps = {}
   
   def _build_handlers(self, output, parameters):
     self._handlers = [cls(output, parameters) for cls in _HANDLER_CLASSES]
@@ -584,18 +2280,478 @@ class Cherry(object):
   def _delete_cache_dir(self):
     shutil.rmtree(self._cache_dir, True)
 
-  def handle(self, cherry_file):
-    # Process files
+  def get_dependencies(self):
+    """Return the paths of the source files of the last build."""
+    return self._dependencies.keys()
+
+  def get_dependency_handlers(self):
+    """Return the list of the source files of the last build, with the
+       names of the handlers which used them.
+    """
+    return self._dependencies.items()
+
+  def _add_dependency(self, path, handler=None):
+    handlers = self._dependencies.setdefault(path, [])
+    if handler is not None and type(handler).__name__ not in handlers:
+      handlers.append(type(handler).__name__)
+
+  def get_outputs(self):
+    """Return the paths of the files generated by the last build."""
+    return [path for handler in self._handlers
+            for path in handler.get_outputs()]
+
+  def get_snapshot(self):
+    return dict((path, self._get_snapshot_entry(path))
+                for path in self._dependencies)
+
+  def _get_snapshot_entry(self, path):
+    try:
+      stat = os.stat(path)
+      return (stat.st_mtime, stat.st_size)
+    except OSError:
+      return None
+
+  def has_changed(self):
+    """Return True if a source file has changed since the last build."""
+    return self.get_snapshot() != self._snapshot
+
+  def _get_stamp(self, zfile):
+    path = zfile.get_path()
+    if path is None:
+      return _hash_contents(zfile.read())
+    try:
+      stat = os.stat(path)
+      return (path, stat.st_mtime, stat.st_size)
+    except OSError:
+      return (path,)
+
+  def handle(self, cherry_file, sink=None):
+    """Build the manifest cherry_file, and return a BuildResult.  The
+       generated files are also written to sink if it is not None (they are
+       always generated next to the output, which holds the manifests and
+       the intermediate files of incremental builds).
+    """
+    with _span('build ' + self._output, 'manifest',
+               manifest=cherry_file.get_path()):
+      return self._handle(cherry_file, sink)
+
+  def _walk(self, cherry_file, handled):
+    # Process files.  Files are handled once, at their first occurrence.
+    # An end marker is pushed below the files of every manifest, in order
+    # to know the chain of manifests including the current file.
     stack = [cherry_file]
+    visited = set()
+    chain = []
     while stack:
       zfile = stack.pop()
+      if zfile is self._END_OF_MANIFEST:
+        chain.pop()
+        continue
+      file_id = zfile.get_id()
+      if file_id is not None:
+        if file_id in chain:
+          raise FatalError('Include cycle: ' +
+                           ' -> '.join(chain[chain.index(file_id):] +
+                                       [file_id]))
+        if file_id in visited:
+          continue
+        visited.add(file_id)
+      if zfile.get_type() == 'cherry':
+        chain.append(file_id)
+        stack.append(self._END_OF_MANIFEST)
+      # Source files are the local files which are not generated by the
+      # build, including the cached copies of remote files.
+      is_source = (
+        isinstance(zfile, FSFile) and not zfile.is_generated() or
+        isinstance(zfile, UrlFile) and not _is_url(zfile.get_path()))
+      if is_source:
+        self._add_dependency(zfile.get_path())
       for handlers in self._handlers_dict[zfile.get_type()]:
-        handlers.handle(zfile, stack)
+        with _span(type(handlers).__name__ + '.handle', 'handle',
+                   path=zfile.get_path()):
+          handlers.handle(zfile, stack)
+        handled[handlers].append(zfile)
+        if is_source:
+          self._add_dependency(zfile.get_path(), handlers)
+    for handler in self._handlers:
+      for path in handler.get_dependencies():
+        self._add_dependency(path, handler)
+
+  def _handle(self, cherry_file, sink):
+    start = time.time()
+    for handler in self._handlers:
+      handler.reset()
+    handled = collections.defaultdict(list)
+    self._dependencies = collections.OrderedDict()
+    try:
+      with _span('walk', 'manifest'):
+        self._walk(cherry_file, handled)
+    finally:
+      self._snapshot = self.get_snapshot()
     # Finalize
     for handler in self._handlers:
-      handler.finalize()
+      with _span(type(handler).__name__ + '.prepare', 'prepare'):
+        handler.prepare()
+    # Handlers whose files and dependencies are unchanged since they were
+    # last finalized by this object are skipped (this happens when
+    # rebuilding with --watch).
+    stamps = dict((handler, [self._get_stamp(zfile)
+                             for zfile in handled[handler]] +
+                            [self._get_stamp(FSFile(path))
+                             for path in handler.get_dependencies()])
+                  for handler in self._handlers)
+    handlers = [handler for handler in self._handlers
+                if self._finalized_stamps.get(handler) != stamps[handler]]
+    # Handlers do not share any data once prepared, so they are finalized
+    # in parallel (most of the time is spent waiting for external tools).
+    timings = {}
+    def finalize(handler):
+      handler_start = time.time()
+      with _span(type(handler).__name__ + '.finalize', 'finalize'):
+        handler.finalize()
+      timings[type(handler).__name__] = time.time() - handler_start
+    errors = _run_in_threads([lambda handler=handler: finalize(handler)
+                              for handler in handlers])
+    if not errors:
+      for handler in handlers:
+        self._finalized_stamps[handler] = stamps[handler]
+    if len(errors) == 1:
+      raise errors[0][0], errors[0][1], errors[0][2]
+    elif errors:
+      raise FatalError('\n'.join(str(error[1]) for error in errors))
+    # Dependencies found while finalizing (e.g. inlined assets).
+    for handler in handlers:
+      for path in handler.get_dependencies():
+        if path not in self._dependencies:
+          self._snapshot[path] = self._get_snapshot_entry(path)
+        self._add_dependency(path, handler)
+    if self._parameters.get_bool(Param.CLEAN):
+      self._clean_hashed_outputs()
+      self._clean_size_report()
+    elif not self._parameters.get_bool(Param.DEV):
+      budgets = self._get_budgets()
+      if budgets or self._parameters.get_bool(Param.SIZE_REPORT):
+        with _span('size report', 'output'):
+          self._check_sizes(budgets)
+      if self._parameters.get_bool(Param.HASH_NAMES):
+        with _span('hashed outputs', 'output'):
+          self._write_hashed_outputs()
+      if self._parameters[Param.COMPRESS]:
+        with _span('compressed outputs', 'output'):
+          self._write_compressed_outputs()
     if self._cache_clean:
       self._delete_cache_dir()
+    outputs = {}
+    if not self._parameters.get_bool(Param.CLEAN):
+      outdir = os.path.dirname(self._output)
+      for path in self.get_outputs():
+        with open(path, 'rb') as f:
+          outputs[path] = f.read()
+        if sink is not None:
+          sink.write(os.path.relpath(path, outdir or '.'), outputs[path])
+    timings['total'] = time.time() - start
+    return BuildResult(outputs, self.get_dependencies(), timings)
+
+  # Hashed outputs: every bundle is copied to <output>.<hash>.<ext>, and the
+  # asset manifest <output>.assets.json maps the bundle names to the hashed
+  # names.  Only the most recent hashed copies of each bundle are kept.
+
+  def _get_assets_path(self):
+    return self._output + '.assets.json'
+
+  def _get_hashed_paths(self, path):
+    """Return the existing hashed copies of path, most recent first."""
+    dirname, basename = os.path.split(path)
+    name, ext = os.path.splitext(basename)
+    regexp = re.compile('^%s\\.[0-9a-f]{%d}%s$' % (
+      re.escape(name), self._HASH_LENGTH, re.escape(ext)))
+    paths = [os.path.join(dirname, filename)
+             for filename in os.listdir(dirname or '.')
+             if regexp.match(filename)]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    return paths
+
+  def _write_hashed_outputs(self):
+    keep = self._parameters.get_int(Param.HASH_KEEP, 3)
+    outputs = self.get_outputs()
+    assets = {}
+    for path in [self._output + '.js', self._output + '.css']:
+      if path not in outputs:
+        continue
+      with open(path, 'rb') as f:
+        contents = f.read()
+      name, ext = os.path.splitext(path)
+      hashed_path = '%s.%s%s' % (
+        name, _hash_contents(contents)[:self._HASH_LENGTH], ext)
+      if not os.path.isfile(hashed_path):
+        _write_file_atomic(hashed_path, contents)
+      assets[os.path.basename(path)] = os.path.basename(hashed_path)
+      old_paths = [old_path for old_path in self._get_hashed_paths(path)
+                   if old_path != hashed_path]
+      for old_path in old_paths[keep - 1:]:
+        self._remove_with_compressed(old_path)
+    with open(self._get_assets_path(), 'w') as f:
+      json.dump(assets, f, indent=1, sort_keys=True)
+
+  def _clean_hashed_outputs(self):
+    for path in [self._output + '.js', self._output + '.css']:
+      self._remove_with_compressed(path)
+      for hashed_path in self._get_hashed_paths(path):
+        self._remove_with_compressed(hashed_path)
+    if os.path.isfile(self._get_assets_path()):
+      os.remove(self._get_assets_path())
+
+  # Size reports: the size of every file of the bundles, minified
+  # separately and gzipped separately, is written to <output>.size.json and
+  # <output>.size.txt.  Budgets are given by parameters or manifest lines
+  # like '#budget: js=300k js.file=100k', the parameters taking precedence.
+  # The budget of a type limits the size of the bundle, type.gzip limits its
+  # gzipped size, and type.file limits the minified size of every file.
+
+  _BUDGET_SUFFIXES = ['', '.gzip', '.file']
+
+  def _get_budgets(self):
+    budgets = {}
+    for handler in self._handlers:
+      if isinstance(handler, CherryHandler):
+        budgets.update(handler.get_budgets())
+    for type_ in ['js', 'css']:
+      for suffix in self._BUDGET_SUFFIXES:
+        value = self._parameters.get_size('budget.' + type_ + suffix)
+        if value is not None:
+          budgets[type_ + suffix] = value
+    unknown = [name for name in budgets
+               if not re.match(r'^(js|css)(\.gzip|\.file)?$', name)]
+    if unknown:
+      raise FatalError('Unknown budget: ' + ', '.join(sorted(unknown)))
+    return budgets
+
+  def _get_size_report(self):
+    report = {}
+    for handler in self._handlers:
+      file_sizes = handler.get_file_sizes()
+      if file_sizes is None:
+        continue
+      out_path, files = file_sizes
+      with open(out_path, 'rb') as f:
+        contents = f.read()
+      report[os.path.splitext(out_path)[1][1:]] = {
+        'bundle': out_path,
+        'size': len(contents),
+        'gzip': len(zlib.compress(contents, 9)),
+        'files': sorted([{'path': name,
+                          'raw': size,
+                          'minified': len(minified),
+                          'gzip': len(zlib.compress(minified, 9))}
+                         for name, size, minified in files],
+                        key=lambda entry: (-entry['minified'], entry['path']))
+      }
+    return report
+
+  def _check_sizes(self, budgets):
+    report = self._get_size_report()
+    if self._parameters.get_bool(Param.SIZE_REPORT):
+      _write_file_atomic(self._output + '.size.json',
+                         json.dumps(report, indent=1, sort_keys=True))
+      lines = []
+      for type_, bundle in sorted(report.items()):
+        lines.append('%s: %d bytes, %d gzipped' % (
+          bundle['bundle'], bundle['size'], bundle['gzip']))
+        lines.append('%10s %10s %10s  %s' % ('minified', 'gzip', 'raw', 'file'))
+        for entry in bundle['files']:
+          lines.append('%10d %10d %10d  %s' % (
+            entry['minified'], entry['gzip'], entry['raw'], entry['path']))
+        lines.append('')
+      _write_file_atomic(self._output + '.size.txt', '\n'.join(lines))
+    errors = []
+    for name, limit in sorted(budgets.items()):
+      type_, _, kind = name.partition('.')
+      if type_ not in report:
+        continue
+      bundle = report[type_]
+      if kind == 'file':
+        errors.extend('%s: %s is %d bytes minified (budget %s: %d)' % (
+          bundle['bundle'], entry['path'], entry['minified'], name, limit)
+          for entry in bundle['files'] if entry['minified'] > limit)
+      else:
+        size = bundle['gzip' if kind == 'gzip' else 'size']
+        if size > limit:
+          errors.append('%s: %d bytes%s (budget %s: %d)' % (
+            bundle['bundle'], size, ' gzipped' if kind else '', name, limit))
+    if errors:
+      raise FatalError('Size budget exceeded:\n' + '\n'.join(errors))
+
+  def _clean_size_report(self):
+    for path in [self._output + '.size.json', self._output + '.size.txt']:
+      if os.path.isfile(path):
+        os.remove(path)
+
+  # Precompression: bundles (and their hashed copies) are compressed to
+  # <path>.gz, and <path>.br if the brotli module is available.  Compressed
+  # files get the modification time of their source, so that they are not
+  # compressed again while the source is unchanged.
+
+  _COMPRESSED_EXTENSIONS = ['.gz', '.br']
+
+  def _remove_with_compressed(self, path):
+    for p in [path] + [path + ext for ext in self._COMPRESSED_EXTENSIONS]:
+      if os.path.isfile(p):
+        os.remove(p)
+
+  def _compress(self, path, ext, level):
+    compressed_path = path + ext
+    stat = os.stat(path)
+    # utime() has a precision of one microsecond.
+    if (os.path.isfile(compressed_path) and
+        abs(os.path.getmtime(compressed_path) - stat.st_mtime) < 1e-3):
+      return
+    with open(path, 'rb') as f:
+      contents = f.read()
+    if ext == '.gz':
+      output = StringIO.StringIO()
+      with gzip.GzipFile(os.path.basename(path), 'wb', level, output,
+                         mtime=0) as f:
+        f.write(contents)
+      compressed = output.getvalue()
+    else:
+      compressed = brotli.compress(contents, quality=min(level, 11))
+    _write_file_atomic(compressed_path, compressed)
+    os.utime(compressed_path, (stat.st_atime, stat.st_mtime))
+
+  def _write_compressed_outputs(self):
+    formats = self._parameters[Param.COMPRESS].split(',')
+    level = self._parameters.get_int(Param.COMPRESS_LEVEL, 9)
+    exts = []
+    for format in formats:
+      if format == 'gzip':
+        exts.append('.gz')
+      elif format == 'br':
+        if brotli is not None:
+          exts.append('.br')
+      else:
+        raise FatalError('Unknown compression format: ' + format)
+    outputs = self.get_outputs()
+    paths = []
+    for path in [self._output + '.js', self._output + '.css']:
+      if path in outputs:
+        paths.append(path)
+        paths.extend(self._get_hashed_paths(path))
+    errors = _run_in_threads([
+      lambda path=path, ext=ext: self._compress(path, ext, level)
+      for path in paths for ext in exts])
+    if errors:
+      raise errors[0][0], errors[0][1], errors[0][2]
+
+
+# *************************************************************************
+# Development server
+
+
+class _DevServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """An HTTP server for --serve.
+
+  Files are served from the root directory.  The outputs of the builds are
+  kept in memory, and other files are kept in memory as long as their
+  modification time is unchanged.  Responses have an ETag, and requests
+  with a matching If-None-Match get a 304.  Pages get a server-sent event
+  on EVENTS_PATH after every build.
+  """
+
+  EVENTS_PATH = '/__cherry/events'
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, root, log_level):
+    BaseHTTPServer.HTTPServer.__init__(self, address, _DevRequestHandler)
+    self.root = os.path.abspath(root)
+    self.log_level = log_level
+    self._files = {}
+    self._condition = threading.Condition()
+    self._generation = 0
+
+  def update(self, outputs):
+    """Load the outputs of a build, and notify the pages."""
+    files = {}
+    for path in outputs:
+      with open(path, 'rb') as f:
+        contents = f.read()
+      files[os.path.abspath(path)] = (None, contents,
+                                      '"%s"' % _hash_contents(contents))
+    with self._condition:
+      self._files.update(files)
+      self._generation += 1
+      self._condition.notify_all()
+
+  def get_file(self, path):
+    """Return the contents and the ETag of a file, or None."""
+    stat = os.stat(path)
+    with self._condition:
+      entry = self._files.get(path)
+    if entry is None or (entry[0] is not None and entry[0] != stat.st_mtime):
+      with open(path, 'rb') as f:
+        contents = f.read()
+      entry = (stat.st_mtime, contents, '"%s"' % _hash_contents(contents))
+      with self._condition:
+        self._files[path] = entry
+    return entry[1], entry[2]
+
+  def wait_for_build(self, generation, timeout):
+    with self._condition:
+      if self._generation == generation:
+        self._condition.wait(timeout)
+      return self._generation
+
+
+class _DevRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    path = urlparse.urlsplit(self.path).path
+    if path == _DevServer.EVENTS_PATH:
+      self._send_events()
+      return
+    fs_path = os.path.normpath(
+      os.path.join(self.server.root, urllib2.unquote(path).lstrip('/')))
+    if (_get_relative_sub_path(fs_path, self.server.root) is None or
+        not os.path.isfile(fs_path)):
+      self.send_error(404)
+      return
+    contents, etag = self.server.get_file(fs_path)
+    if self.headers.get('If-None-Match') == etag:
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header('Content-Type',
+                     mimetypes.guess_type(fs_path)[0] or
+                     'application/octet-stream')
+    self.send_header('Content-Length', str(len(contents)))
+    self.send_header('ETag', etag)
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+    self.wfile.write(contents)
+
+  def _send_events(self):
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+    generation = self.server.wait_for_build(None, 0)
+    try:
+      while True:
+        new_generation = self.server.wait_for_build(generation, 15)
+        if new_generation != generation:
+          self.wfile.write('data: reload\n\n')
+          generation = new_generation
+        else:
+          self.wfile.write(': ping\n\n')
+        self.wfile.flush()
+    except socket.error:
+      pass
+
+  def log_message(self, format, *args):
+    if self.server.log_level >= LogLevel.VERBOSE:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
 
 
 # *************************************************************************
@@ -628,6 +2784,173 @@ def _parse_cache_options(value, parameters):
       raise FatalError('Unknown flag for --cache-options: ' + part)
 
 
+def _create_cherry(path, parameters):
+  parameters = Parameters(parameters)
+  parameters[Param.CACHE_DIR] = _get_cache_dir(path)
+  output = parameters[Param.OUTPUT] or os.path.splitext(path)[0]
+  return Cherry(output, parameters)
+
+
+def build(path, parameters=None, sink=None):
+  """Build the manifest at path, and return a BuildResult.  parameters is a
+     dictionary indexed by the Param names, and the generated files are
+     also written to sink if it is not None (e.g. a MemorySink).
+  """
+  return _create_cherry(path, parameters or {}).handle(FSFile(path), sink)
+
+
+def _build(path, parameters):
+  """Build a manifest, and return its outputs and its source files, with the
+     handlers which used them.
+  """
+  cherry = _create_cherry(path, parameters)
+  cherry.handle(FSFile(path))
+  return cherry.get_outputs(), cherry.get_dependency_handlers()
+
+
+def _build_in_worker(args):
+  """Build a manifest in a worker process of _build_all.  Return the path,
+     the log of the build, an error message or None, the result of _build,
+     and the profile events of the build.
+  """
+  global _profiler
+  path, parameters, profile = args
+  stdout = sys.stdout
+  sys.stdout = log = StringIO.StringIO()
+  _profiler = Profiler() if profile else None
+  result = None
+  try:
+    result = _build(path, parameters)
+    error = None
+  except (FatalError, RunError, EnvironmentError) as e:
+    error = str(e)
+  except Exception:
+    error = traceback.format_exc()
+  finally:
+    sys.stdout = stdout
+  events = _profiler.get_events() if profile else []
+  _profiler = None
+  return path, log.getvalue(), error, result, events
+
+
+def _build_all(paths, parameters, jobs):
+  """Build several manifests in a pool of processes.  The log of every
+     build is printed at once, in the order of paths.  Return the list of
+     the results of _build.
+  """
+  pool = multiprocessing.Pool(min(jobs, len(paths)))
+  failures = []
+  results = []
+  try:
+    for path, log, error, result, events in pool.imap(
+        _build_in_worker,
+        [(path, dict(parameters), _profiler is not None) for path in paths]):
+      if _profiler is not None:
+        _profiler.add_events(events)
+      sys.stdout.write(log)
+      sys.stdout.flush()
+      if error is not None:
+        print >> sys.stderr, 'Failed: %s' % path
+        failures.append((path, error))
+      else:
+        results.append(result)
+  finally:
+    pool.close()
+    pool.join()
+  if failures:
+    path, error = failures[0]
+    raise FatalError('%d of %d manifests failed.  First failure: %s\n%s' %
+                     (len(failures), len(paths), path, error))
+  return results
+
+
+def _escape_make(path):
+  return re.sub(r'([ #\\])', r'\\\1', path).replace('$', '$$')
+
+
+def _write_depfile(depfile, results):
+  """Write a Makefile rule for the outputs of every build, depending on its
+     source files.
+  """
+  with open(depfile, 'w') as f:
+    for outputs, dependencies in results:
+      if outputs:
+        f.write('%s: %s\n' % (
+          ' '.join(_escape_make(path) for path in outputs),
+          ' \\\n  '.join(_escape_make(path) for path, _ in dependencies)))
+
+
+def _write_deps_json(deps_json, results):
+  with open(deps_json, 'w') as f:
+    json.dump([{'outputs': outputs,
+                'inputs': [{'path': path, 'handlers': handlers}
+                           for path, handlers in dependencies]}
+               for outputs, dependencies in results], f, indent=1)
+
+
+def _watch(paths, parameters, on_build=None):
+  """Build the manifests, and build them again every time one of their
+     source files changes, until interrupted.  Every manifest keeps its
+     Cherry object, so that only the handlers with changed files are
+     finalized again.  on_build is called with the Cherry object after
+     every successful build.
+  """
+  interval = parameters.get_float(Param.WATCH_INTERVAL, 0.25)
+  debounce = parameters.get_float(Param.WATCH_DEBOUNCE, 0.2)
+  builds = []
+  for path in paths:
+    builds.append((path, _create_cherry(path, parameters)))
+  dirty = builds
+  try:
+    while True:
+      for path, cherry in dirty:
+        start = time.time()
+        try:
+          cherry.handle(FSFile(path))
+          print 'Built %s in %.2fs' % (path, time.time() - start)
+          if on_build:
+            on_build(cherry)
+        except (FatalError, RunError, EnvironmentError) as e:
+          print >> sys.stderr, str(e)
+      print 'Watching for changes...'
+      sys.stdout.flush()
+      dirty = []
+      while not dirty:
+        time.sleep(interval)
+        dirty = [build for build in builds if build[1].has_changed()]
+      # Wait until nothing has changed during the debounce delay, so that a
+      # burst of changes (e.g. a git checkout) triggers a single build.
+      snapshot = None
+      while True:
+        new_snapshot = [cherry.get_snapshot() for _, cherry in builds]
+        if new_snapshot == snapshot:
+          break
+        snapshot = new_snapshot
+        time.sleep(debounce)
+      dirty = [build for build in builds if build[1].has_changed()]
+  except KeyboardInterrupt:
+    pass
+
+
+def _serve(paths, parameters):
+  """Run the development server, and rebuild the manifests when their
+     source files change.
+  """
+  address = (parameters[Param.SERVE_HOST] or 'localhost',
+             parameters.get_int(Param.SERVE_PORT, 8000))
+  server = _DevServer(address, '.', parameters[Param.LOG_LEVEL] or
+                      LogLevel.DEFAULT)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  print 'Serving on http://%s:%d/' % address
+  try:
+    _watch(paths, parameters,
+           lambda cherry: server.update(cherry.get_outputs()))
+  finally:
+    server.shutdown()
+
+
 def _update_cherry(use_wget):
   print 'Downloading ' + _UPDATE_URL
   contents = read_url(_UPDATE_URL, use_wget)
@@ -637,6 +2960,7 @@ def _update_cherry(use_wget):
 
 
 def main():
+  global _profiler
   parser = argparse.ArgumentParser(description=_DESCRIPTION)
   parser.add_argument('file',
                       type=str,
@@ -671,6 +2995,20 @@ def main():
                       dest='cache_options',
                       default='',
                       metavar='OPTION1,OPTION2,...')
+  parser.add_argument('--shared-cache',
+                      help=('Cache remote files in a directory shared by all '
+                            'projects (size limit: -s shared_cache_size=SIZE)'),
+                      action='store',
+                      type=str,
+                      dest='shared_cache',
+                      metavar='DIR')
+  parser.add_argument('--artifact-cache',
+                      help=('Share the outputs of the external tools in a '
+                            'directory, or on an HTTP server (GET and PUT)'),
+                      action='store',
+                      type=str,
+                      dest='artifact_cache',
+                      metavar='DIR|URL')
   parser.add_argument('-o', '--output',
                       action='store',
                       type=str,
@@ -697,46 +3035,104 @@ def main():
                       dest='use_wget',
                       help='Use wget to download files',
                       default=False)
+  parser.add_argument('--watch',
+                      action='store_true',
+                      dest='watch',
+                      help='Rebuild when source files change',
+                      default=False)
+  parser.add_argument('--serve',
+                      action='store_true',
+                      dest='serve',
+                      help=('Serve the application in development mode, and '
+                            'reload pages when source files change'),
+                      default=False)
+  parser.add_argument('--depfile',
+                      action='store',
+                      type=str,
+                      dest='depfile',
+                      help='Write the source files as a Makefile rule',
+                      metavar='FILE')
+  parser.add_argument('--deps-json',
+                      action='store',
+                      type=str,
+                      dest='deps_json',
+                      help='Write the source files and their handlers as JSON',
+                      metavar='FILE')
+  parser.add_argument('--profile',
+                      action='store',
+                      type=str,
+                      dest='profile',
+                      help='Write a Chrome trace of the build',
+                      metavar='FILE')
+  parser.add_argument('-j', '--jobs',
+                      action='store',
+                      type=int,
+                      dest='jobs',
+                      help='Number of manifests to build in parallel',
+                      default=1,
+                      metavar='N')
   args = parser.parse_args()
   if args.update:
     _update_cherry(args.use_wget)
     return
-  parameters = collections.defaultdict(lambda: None)
+  parameters = Parameters()
   for name, value in (entry.split('=', 1) for entry in
                       (args.parameters_list or [])):
     parameters[name] = value
   if args.clean: parameters[Param.CLEAN] = True
-  if args.dev: parameters[Param.DEV] = True
+  if args.dev or args.serve: parameters[Param.DEV] = True
+  if args.serve: parameters[Param.SERVE] = True
   if args.use_wget: parameters[Param.USE_WGET] = True
   if args.cache: 
-    if not args.dev:
+    if not (args.dev or args.serve):
       raise FatalError('--cache cannot be used without --dev')
     parameters[Param.CACHE] = True
+  if args.shared_cache: parameters[Param.SHARED_CACHE] = args.shared_cache
+  if args.artifact_cache:
+    parameters[Param.ARTIFACT_CACHE] = args.artifact_cache
   _parse_cache_options(args.cache_options, parameters)
   if args.pretty: parameters[Param.PRETTY] = True
   if args.log_level: parameters[Param.LOG_LEVEL] = args.log_level
   if not args.file:
     args.file = ['.']
-  if args.output and len(args) > 1:
+  if args.output: parameters[Param.OUTPUT] = args.output
+  paths = []
+  for arg in args.file:
+    if os.path.isdir(arg):
+      paths.extend(path for path in os.listdir(arg) if _is_cherry_file(path))
+    else:
+      paths.append(arg)
+  if args.output and len(paths) > 1:
     raise FatalError('--output cannot be used with several inputs')
+  if (args.watch or args.serve) and args.clean:
+    raise FatalError('--watch and --serve cannot be used with --clean')
+  if args.profile:
+    _profiler = Profiler()
   try:
-    for arg in args.file:
-      if os.path.isdir(arg):
-        paths = [path for path in os.listdir(arg) if _is_cherry_file(path)]
+    if args.serve:
+      _serve(paths, parameters)
+    elif args.watch:
+      _watch(paths, parameters)
+    else:
+      if args.jobs > 1 and len(paths) > 1:
+        results = _build_all(paths, parameters, args.jobs)
       else:
-        paths = [arg]
-      for path in paths:
-        output, _ = os.path.splitext(path)
-        parameters[Param.CACHE_DIR] = _get_cache_dir(path)
-        cherry = Cherry(output, parameters)
-        cherry.handle(FSFile(path))
+        results = [_build(path, parameters) for path in paths]
+      if args.depfile and not args.clean:
+        _write_depfile(args.depfile, results)
+      if args.deps_json and not args.clean:
+        _write_deps_json(args.deps_json, results)
   except RunError as e:
     raise FatalError(str(e))
+  finally:
+    if args.profile:
+      _profiler.write(args.profile)
 
 
-try:
-  main()
-except FatalError as e:
-  print >> sys.stderr, str(e)
-  exit(1)
+if __name__ == '__main__':
+  try:
+    main()
+  except FatalError as e:
+    print >> sys.stderr, str(e)
+    exit(1)
   
@@ -0,0 +1,384 @@
+#!/usr/bin/python
+#
+# Tests of cherry.py.  Run with: python test/cherry_test.py
+
+import BaseHTTPServer
+import os
+import shutil
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import cherry
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """A local HTTP server standing for a CDN.  Files are served from the
+     files dictionary, and every request is recorded in requests.
+  """
+
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+    self.files = {}
+    self.etags = {}
+    self.redirects = {}
+    self.failures = {}
+    self.delay = 0
+    self.requests = []
+    self.active = 0
+    self.max_active = 0
+    self.lock = threading.Lock()
+
+  def get_url(self, path):
+    return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    server = self.server
+    with server.lock:
+      server.requests.append((self.command, self.path, dict(self.headers)))
+      server.active += 1
+      server.max_active = max(server.max_active, server.active)
+      fail = server.failures.get(self.path, 0) > 0
+      if fail:
+        server.failures[self.path] -= 1
+    try:
+      time.sleep(server.delay)
+      if fail:
+        # Close the connection without any response.
+        self.close_connection = True
+      elif self.path in server.redirects:
+        self._respond(302, '', {'Location': server.redirects[self.path]})
+      elif self.path not in server.files:
+        self._respond(404, '')
+      elif (self.path in server.etags and
+            self.headers.get('If-None-Match') == server.etags[self.path]):
+        self._respond(304, None, {'ETag': server.etags[self.path]})
+      else:
+        headers = {}
+        if self.path in server.etags:
+          headers['ETag'] = server.etags[self.path]
+        self._respond(200, server.files[self.path], headers)
+    finally:
+      with server.lock:
+        server.active -= 1
+
+  def do_PUT(self):
+    server = self.server
+    body = self.rfile.read(int(self.headers['Content-Length']))
+    with server.lock:
+      server.requests.append((self.command, self.path, dict(self.headers)))
+      server.files[self.path] = body
+    self._respond(201, '')
+
+  def _respond(self, status, body, headers={}):
+    self.send_response(status)
+    for name, value in headers.items():
+      self.send_header(name, value)
+    if body is not None:
+      self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if body:
+      self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class _ServerTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.server = _Server()
+    self.thread = threading.Thread(target=self.server.serve_forever,
+                                   args=(0.05,))
+    self.thread.daemon = True
+    self.thread.start()
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmp_dir, True)
+
+  def get_requests(self, path):
+    return [request for request in self.server.requests
+            if request[1] == path]
+
+
+class DownloaderTest(_ServerTestCase):
+
+  def test_parallel_fetch(self):
+    paths = ['/lib%d.js' % i for i in range(4)]
+    for path in paths:
+      self.server.files[path] = 'var %s;' % path[1:-3]
+    self.server.delay = 0.3
+    downloader = cherry.Downloader(cherry.Parameters(download_jobs='4'))
+    try:
+      start = time.time()
+      contents = downloader.map(downloader.read,
+                                [self.server.get_url(path) for path in paths])
+      duration = time.time() - start
+    finally:
+      downloader.close()
+    self.assertEqual(['var lib%d;' % i for i in range(4)], contents)
+    self.assertEqual(4, self.server.max_active)
+    self.assertTrue(duration < 1.0, duration)
+
+  def test_retry(self):
+    self.server.files['/flaky.js'] = 'flaky();'
+    self.server.failures['/flaky.js'] = 2
+    downloader = cherry.Downloader(cherry.Parameters(download_retries='2'))
+    try:
+      self.assertEqual('flaky();',
+                       downloader.read(self.server.get_url('/flaky.js')))
+    finally:
+      downloader.close()
+    self.assertEqual(3, len(self.get_requests('/flaky.js')))
+
+  def test_retry_limit(self):
+    self.server.files['/flaky.js'] = 'flaky();'
+    self.server.failures['/flaky.js'] = 3
+    zfile = cherry.UrlFile(self.server.get_url('/flaky.js'),
+                           cherry.Parameters(download_retries='2'))
+    self.assertRaises(cherry.FatalError, zfile.read)
+
+  def test_redirect(self):
+    self.server.files['/v2/lib.js'] = 'lib();'
+    self.server.redirects['/lib.js'] = self.server.get_url('/v2/lib.js')
+    downloader = cherry.Downloader(cherry.Parameters())
+    try:
+      self.assertEqual('lib();',
+                       downloader.read(self.server.get_url('/lib.js')))
+    finally:
+      downloader.close()
+
+  def test_redirect_loop(self):
+    self.server.redirects['/loop.js'] = '/loop.js'
+    zfile = cherry.UrlFile(self.server.get_url('/loop.js'),
+                           cherry.Parameters())
+    self.assertRaises(cherry.FatalError, zfile.read)
+
+  def test_not_found(self):
+    zfile = cherry.UrlFile(self.server.get_url('/missing.js'),
+                           cherry.Parameters())
+    self.assertRaises(cherry.FatalError, zfile.read)
+    self.assertEqual(1, len(self.get_requests('/missing.js')))
+
+
+class UrlFileCacheTest(_ServerTestCase):
+
+  def load(self, path, cache_download=cherry.CacheDownload.AUTO):
+    parameters = cherry.Parameters()
+    parameters[cherry.Param.CACHE] = True
+    parameters[cherry.Param.CACHE_DIR] = self.tmp_dir
+    parameters[cherry.Param.CACHE_DOWNLOAD] = cache_download
+    zfile = cherry.UrlFile(self.server.get_url(path), parameters)
+    zfile.load()
+    return zfile
+
+  def test_revalidation(self):
+    self.server.files['/lib.js'] = 'lib();'
+    self.server.etags['/lib.js'] = '"v1"'
+    self.assertEqual('lib();', self.load('/lib.js').read())
+    zfile = self.load('/lib.js')
+    self.assertEqual('lib();', zfile.read())
+    requests = self.get_requests('/lib.js')
+    self.assertEqual(2, len(requests))
+    self.assertEqual('"v1"', requests[1][2].get('if-none-match'))
+
+  def test_revalidation_changed(self):
+    self.server.files['/lib.js'] = 'lib();'
+    self.server.etags['/lib.js'] = '"v1"'
+    self.load('/lib.js')
+    self.server.files['/lib.js'] = 'lib2();'
+    self.server.etags['/lib.js'] = '"v2"'
+    self.assertEqual('lib2();', self.load('/lib.js').read())
+
+  def test_local(self):
+    self.server.files['/lib.js'] = 'lib();'
+    self.load('/lib.js')
+    zfile = self.load('/lib.js', cherry.CacheDownload.LOCAL)
+    self.assertEqual('lib();', zfile.read())
+    self.assertEqual(1, len(self.get_requests('/lib.js')))
+
+  def test_offline(self):
+    self.server.files['/lib.js'] = 'lib();'
+    self.load('/lib.js')
+    del self.server.files['/lib.js']
+    self.assertEqual('lib();', self.load('/lib.js').read())
+    self.assertRaises(cherry.FatalError, self.load, '/lib.js',
+                      cherry.CacheDownload.FORCE)
+
+  def test_clean(self):
+    self.server.files['/lib.js'] = 'lib();'
+    parameters = cherry.Parameters()
+    parameters[cherry.Param.CLEAN] = True
+    zfile = cherry.UrlFile(self.server.get_url('/lib.js'), parameters)
+    zfile.load()
+    self.assertTrue(zfile.is_loaded())
+    self.assertEqual([], self.get_requests('/lib.js'))
+
+
+class ArtifactCacheTest(_ServerTestCase):
+
+  def check_round_trip(self, cache):
+    self.assertEqual(None, cache.get('0123abcd'))
+    cache.put('0123abcd', 'var a;\n')
+    self.assertEqual('var a;\n', cache.get('0123abcd'))
+    self.assertEqual(None, cache.get('4567abcd'))
+
+  def test_local(self):
+    self.check_round_trip(cherry.LocalArtifactCache(self.tmp_dir))
+    self.assertTrue(os.path.isfile(
+      os.path.join(self.tmp_dir, '01', '0123abcd')))
+
+  def test_http(self):
+    cache = cherry.HttpArtifactCache(self.server.get_url('/cache/'), 5)
+    self.check_round_trip(cache)
+    self.assertEqual(
+      [('GET', '/cache/0123abcd'), ('PUT', '/cache/0123abcd'),
+       ('GET', '/cache/0123abcd'), ('GET', '/cache/4567abcd')],
+      [request[:2] for request in self.server.requests])
+
+  def test_http_unavailable(self):
+    # A port on which nothing listens.
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    cache = cherry.HttpArtifactCache('http://127.0.0.1:%d/cache' % port, 5)
+    cache.put('0123abcd', 'var a;')
+    self.assertEqual(None, cache.get('0123abcd'))
+
+  def test_get_artifact_cache(self):
+    parameters = cherry.Parameters()
+    self.assertEqual(None, cherry._get_artifact_cache(parameters))
+    parameters[cherry.Param.ARTIFACT_CACHE] = self.tmp_dir
+    self.assertTrue(isinstance(cherry._get_artifact_cache(parameters),
+                               cherry.LocalArtifactCache))
+    parameters[cherry.Param.ARTIFACT_CACHE] = self.server.get_url('/')
+    self.assertTrue(isinstance(cherry._get_artifact_cache(parameters),
+                               cherry.HttpArtifactCache))
+
+  def test_tool_version(self):
+    tool = os.path.join(self.tmp_dir, 'tool')
+    def write_tool(version, mtime):
+      with open(tool, 'w') as f:
+        f.write('#!/bin/sh\necho %s\n' % version)
+      os.chmod(tool, 0755)
+      os.utime(tool, (mtime, mtime))
+    write_tool('1.0', 1000000000)
+    self.assertEqual('1.0', cherry._get_tool_version(tool))
+    write_tool('2.0', 1000000001)
+    self.assertEqual('2.0', cherry._get_tool_version(tool))
+    self.assertEqual(None, cherry._get_tool_version(tool + '-missing'))
+
+
+class CssTest(unittest.TestCase):
+
+  def test_minify(self):
+    for contents, expected in [
+        ('a { color : red ; }\n\n', 'a{color :red}'),
+        ('/* comment */ a  >  b , c { }', 'a>b,c{}'),
+        ('a:hover { color: red; }', 'a:hover{color:red}'),
+        ('a { content: "a;b /* c */" ; }', 'a{content:"a;b /* c */"}'),
+        ("a { content: 'a }' }", "a{content:'a }'}"),
+        ('a { width: calc( 100%  -  10px ); }', 'a{width:calc( 100% - 10px )}'),
+        ('@media (max-width: 10px) { a { b: c; } }',
+         '@media (max-width:10px){a{b:c}}'),
+      ]:
+      self.assertEqual(expected,
+                       cherry._process_css(contents, 'style.css', '', True))
+
+  def test_pretty(self):
+    contents = 'a {\n  color: red; /* comment */\n}\n'
+    self.assertEqual(contents,
+                     cherry._process_css(contents, 'style.css', '', False))
+
+  def test_rewrite_url(self):
+    for contents, expected in [
+        ('a{b:url(img/a.png)}', 'a{b:url(css/img/a.png)}'),
+        ('a{b:url( "../img/a.png?v=1#x" )}', 'a{b:url("img/a.png?v=1#x")}'),
+        ("a{b:url('../../a.png')}", "a{b:url('../a.png')}"),
+        ('a{b:url(/a.png)}', 'a{b:url(/a.png)}'),
+        ('a{b:url(#filter)}', 'a{b:url(#filter)}'),
+        ('a{b:url(http://cdn/a.png)}', 'a{b:url(http://cdn/a.png)}'),
+        ("a{b:url('data:image/png;base64,AA==')}",
+         "a{b:url('data:image/png;base64,AA==')}"),
+        ('a{content:"url(a.png)"}', 'a{content:"url(a.png)"}'),
+      ]:
+      self.assertEqual(expected,
+                       cherry._process_css(contents, 'css/style.css', '', True))
+
+  def test_rewrite_url_outdir(self):
+    self.assertEqual(
+      'a{b:url(../css/a.png)}',
+      cherry._process_css('a{b:url(a.png)}', 'css/style.css', 'out', True))
+    self.assertEqual(
+      'a{b:url(http://cdn/lib/img/a.png)}',
+      cherry._process_css('a{b:url(img/a.png)}', 'http://cdn/lib/style.css',
+                          'out', True))
+
+
+class SourceMapTest(unittest.TestCase):
+
+  def test_mappings(self):
+    for mappings, lines in [
+        ('', [[]]),
+        ('AAAA', [[[0, 0, 0, 0]]]),
+        ('AAAA;AACA,EAAE,CAAC;;ACDA,gBAAgB',
+         [[[0, 0, 0, 0]], [[0, 0, 1, 0], [2, 0, 1, 2], [3, 0, 1, 3]], [],
+          [[0, 1, 0, 3], [16, 1, 0, 19]]]),
+        ('AAAAA,CAACC,E', [[[0, 0, 0, 0, 0], [1, 0, 0, 1, 1], [3]]]),
+        ('6kjBAAA,kBAAkB', [[[17997, 0, 0, 0], [18015, 0, 0, 18]]]),
+      ]:
+      self.assertEqual(lines, cherry._decode_mappings(mappings))
+      self.assertEqual(mappings, cherry._encode_mappings(lines))
+
+  def test_negative_deltas(self):
+    lines = [[[5, 1, 10, 20], [6, 0, 2, 0]], [[0, 1, 0, 3]]]
+    self.assertEqual(lines,
+                     cherry._decode_mappings(cherry._encode_mappings(lines)))
+
+  def test_compose(self):
+    # The bundle maps to a generated file, whose own map points to the
+    # original file.
+    input_map = {
+      'version': 3,
+      'sources': ['src/a.ts'],
+      'names': ['foo'],
+      'mappings': cherry._encode_mappings([[[0, 0, 4, 2, 0], [10, 0, 5, 0]]]),
+      'sourcesContent': ['original'],
+    }
+    source_map = {
+      'version': 3,
+      'file': 'out.js',
+      'sources': ['a.js', 'b.js'],
+      'names': [],
+      'mappings': cherry._encode_mappings(
+        [[[0, 0, 0, 0], [7, 0, 0, 12], [9, 1, 0, 0]], [[0]]]),
+    }
+    result = cherry._compose_source_maps(
+      source_map, ['lib/a.js', 'lib/b.js'], {0: input_map})
+    self.assertEqual('out.js', result['file'])
+    self.assertEqual(['src/a.ts', 'lib/b.js'], result['sources'])
+    self.assertEqual(['foo'], result['names'])
+    self.assertEqual(['original', None], result['sourcesContent'])
+    self.assertEqual(
+      [[[0, 0, 4, 2, 0], [7, 0, 5, 0], [9, 1, 0, 0]], [[0]]],
+      cherry._decode_mappings(result['mappings']))
+
+
+if __name__ == '__main__':
+  unittest.main()